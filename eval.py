@@ -1,17 +1,27 @@
 from __future__ import print_function
 
 from train import parse_args
-from utils.distributed import synchronize, get_rank, make_data_sampler, make_batch_data_sampler
+from utils.distributed import (synchronize, get_rank, get_world_size, all_gather, all_reduce_sum,
+                               make_data_sampler, make_batch_data_sampler, GroupedBatchSampler,
+                               SkipSampler)
+from utils.eval_state import EvalCheckpoint
 from utils.logger import setup_logger
-from utils.visualize import get_color_pallete
-from utils.score import SegmentationMetric
+from utils.pred_writer import PredictionWriter
+from utils.score import SegmentationMetric, ConditionSegmentationMetric, condition_tagger
+from utils.collate import pad_collate, unpad, image_sizes
+from utils.inference import (get_seg_logits, sliding_window_inference, MultiScaleFlipInference,
+                             tta_cost_report, AutocastInference, amp_accuracy_guard)
 from models import get_segmentation_model
+from models.checkpoint import build_from_checkpoint
+from models.quantize import quantize_int8, build_int8_from_checkpoint, int8_cost_report
+from models.optimize import optimize_for_inference
 from dataloader.cityscapes import CitySegmentation
 from torchvision import transforms
 import torch.backends.cudnn as cudnn
 import torch.utils.data as data
 import torch.nn as nn
 import torch
+import argparse
 import os
 import sys
 
@@ -27,7 +37,7 @@ class Evaluator(object):
         self.device = torch.device(args.device)
 
         # image transform
-        input_transform = transforms.Compose([
+        self.input_transform = input_transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize([.485, .456, .406], [.229, .224, .225]),
         ])
@@ -35,72 +45,322 @@ class Evaluator(object):
         # dataset and dataloader
         val_dataset = CitySegmentation(
             args.data_path, split='val', mode='testval', transform=input_transform)
-        val_sampler = make_data_sampler(val_dataset, False, args.distributed)
-        val_batch_sampler = make_batch_data_sampler(
-            val_sampler, images_per_batch=1)
+        # no padding: every val sample is scored exactly once across ranks
+        val_sampler = make_data_sampler(val_dataset, False, args.distributed, pad=False)
+        # periodically saved progress; a resumed run skips the samples it already scored
+        self.eval_state = None
+        if args.eval_state:
+            path = args.eval_state
+            if get_world_size() > 1:
+                path = '{}.rank{}'.format(path, get_rank())
+            self.eval_state = EvalCheckpoint(path, every=args.eval_state_every, meta={
+                'model': args.model, 'weights': args.weights, 'dataset_size': len(val_dataset),
+                'world_size': get_world_size()})
+            val_sampler = SkipSampler(val_sampler, self.eval_state.done)
+        val_batch_sampler = self.make_batch_sampler(val_dataset, val_sampler)
         self.val_loader = data.DataLoader(dataset=val_dataset,
                                           batch_sampler=val_batch_sampler,
+                                          collate_fn=pad_collate,
                                           num_workers=args.workers,
                                           pin_memory=True)
 
         # create network
         BatchNorm2d = nn.SyncBatchNorm if args.distributed else nn.BatchNorm2d
-        self.model = get_segmentation_model(
-            model=args.model, pretrained=False).to(self.device)
-
-        if self.args.pretrained:
-            self.model.load_state_dict(torch.load(
-                "./trained_models/ddrnet_23_dualresnet_citys_best_model.pth",
-                map_location=self.args.device))
+        if args.int8:
+            if args.output_labels:
+                raise ValueError("--output-labels cannot be combined with an INT8 model")
+            self.model = build_int8_from_checkpoint(get_segmentation_model, args.weights,
+                                                    backend=args.quant_backend,
+                                                    model=args.model, pretrained=False)
+            logger.info("INT8 model restored successfully!!!!")
+        elif self.args.pretrained:
+            # build without random init and take the weights straight from the checkpoint
+            self.model = build_from_checkpoint(get_segmentation_model, args.weights,
+                                               map_location=self.args.device,
+                                               model=args.model, pretrained=False)
             logger.info("Model restored successfully!!!!")
+        else:
+            self.model = get_segmentation_model(
+                model=args.model, pretrained=False).to(self.device)
+        # the auxiliary C/A outputs are only needed for training
+        self.model.inference_only = True
+        if args.output_labels:
+            if args.tta_scales or args.tile_size:
+                raise ValueError("--output-labels cannot be combined with TTA or tiled inference")
+            self.model.output_labels = True
 
-        if args.distributed:
+        if args.distributed and not args.int8:
             self.model = nn.parallel.DistributedDataParallel(self.model,
                                                              device_ids=[args.local_rank], output_device=args.local_rank)
 
         self.model.to(self.device)
 
+        # channels-last and/or compiled copy of the model used for inference
+        self.inference_model = None
+        if args.channels_last or args.compile:
+            if args.int8 or args.output_labels:
+                raise ValueError("--channels-last/--compile cannot be combined with --int8 "
+                                 "or --output-labels")
+            model = self.model.module if args.distributed else self.model
+            self.inference_model = optimize_for_inference(
+                model, channels_last=args.channels_last, use_compile=args.compile,
+                cache_dir=args.compile_cache if args.compile else None)
+        if args.amp and args.int8:
+            raise ValueError("--amp cannot be combined with an INT8 model")
+
         self.metric = SegmentationMetric(val_dataset.num_class)
+        # optional per-condition (e.g. time of day) slices of the metric
+        self.condition_metric = None
+        if args.condition_regex or args.condition_index:
+            self.condition_of = condition_tagger(args.condition_regex, args.condition_index)
+            self.condition_metric = ConditionSegmentationMetric(val_dataset.num_class)
+
+    def predict(self, model, image):
+        """Segmentation scores of a batch: test-time augmented, tiled or full-frame."""
+        if self.args.tta_scales:
+            engine = MultiScaleFlipInference(model, scales=self.args.tta_scales,
+                                             flip=self.args.tta_flip)
+            return engine(image)
+        if self.args.tile_size:
+            return sliding_window_inference(model, image, self.metric.nclass,
+                                            tile_size=tuple(self.args.tile_size * 2)[-2:],
+                                            overlap=self.args.tile_overlap,
+                                            blend=self.args.tile_blend)
+        return get_seg_logits(model(image))
+
+    def make_batch_sampler(self, dataset, sampler):
+        """Batches of up to --eval-batch-size images, all of the same size if the
+        image sizes of ``dataset`` are known, so no sample is padded."""
+        batch_size = self.args.eval_batch_size
+        sizes = image_sizes(dataset) if batch_size > 1 else None
+        if sizes is not None:
+            return GroupedBatchSampler(sampler, sizes, batch_size)
+        if batch_size > 1:
+            logger.warning("Image sizes are unknown; images of unequal size are padded, which "
+                           "changes their logits near the padding against batch size 1")
+        return make_batch_data_sampler(sampler, images_per_batch=batch_size, drop_last=False)
+
+    def amp_check_loader(self):
+        """Loader over --amp-check-batches batches of evenly spaced --amp-check-split
+        images, held out from the evaluated val set."""
+        dataset = CitySegmentation(self.args.data_path, split=self.args.amp_check_split,
+                                   mode='testval', transform=self.input_transform)
+        num_samples = min(len(dataset), self.args.amp_check_batches * self.args.eval_batch_size)
+        dataset = data.Subset(dataset, [i * len(dataset) // num_samples for i in range(num_samples)])
+        sampler = make_data_sampler(dataset, False, self.args.distributed, pad=False)
+        batch_sampler = self.make_batch_sampler(dataset, sampler)
+        return data.DataLoader(dataset=dataset, batch_sampler=batch_sampler, collate_fn=pad_collate,
+                               num_workers=self.args.workers, pin_memory=True)
+
+    def enable_amp(self, model):
+        """Autocast version of ``model``, if it keeps the mIoU of the held-out
+        check images within --amp-max-drop points of fp32. Otherwise returns
+        ``model`` unchanged."""
+        dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[self.args.amp]
+        amp_model = AutocastInference(model, dtype=dtype, device_type=self.device.type)
+        ok, report = amp_accuracy_guard(model, amp_model, self.amp_check_loader(),
+                                        self.metric.nclass, max_drop=self.args.amp_max_drop,
+                                        max_batches=None, device=self.device)
+        logger.info("Mixed precision check:\n{}".format(report))
+        if not ok:
+            logger.warning("{} inference loses more than {:.2f} mIoU points, "
+                           "keeping fp32".format(self.args.amp, self.args.amp_max_drop))
+            amp_model.close()
+            return model
+        return amp_model
 
     def eval(self):
         self.metric.reset()
+        if self.condition_metric is not None:
+            self.condition_metric.reset()
+        metrics = {'metric': self.metric}
+        if self.condition_metric is not None:
+            metrics['condition_metric'] = self.condition_metric
+        num_samples = 0
+        if self.eval_state is not None:
+            num_samples = self.eval_state.restore(metrics)
         self.model.eval()
         if self.args.distributed:
             model = self.model.module
         else:
             model = self.model
+        if self.inference_model is not None:
+            model = self.inference_model
+        if self.args.amp:
+            model = self.enable_amp(model)
         logger.info("Start validation, Total sample: {:d}".format(
-            len(self.val_loader)))
-        for i, (image, target, filename) in enumerate(self.val_loader):
-            image = image.to(self.device)
-            target = target.to(self.device)
-
-            with torch.no_grad():
-                outputs, _, _ = model(image)
-            self.metric.update(outputs[0], target)
-            pixAcc, mIoU = self.metric.get()
-            logger.info("Sample: {:d}, validation pixAcc: {:.3f}, mIoU: {:.3f}".format(
-                i + 1, pixAcc * 100, mIoU * 100))
-
-            if self.args.save_pred:
-                pred = torch.argmax(outputs[0], 1)
-                pred = pred.cpu().data.numpy()
-
-                predict = pred.squeeze(0)
-                mask = get_color_pallete(predict, self.args.dataset)
-                mask.save(os.path.join(
-                    outdir, os.path.splitext(filename[0])[0] + '.png'))
-        logger.info("Whole validation set mIoU: {:.3f}".format(mIoU * 100))
+            len(self.val_loader.dataset)))
+        writer = None
+        if self.args.save_pred:
+            writer = PredictionWriter(self.args.dataset,
+                                      num_workers=self.args.save_workers,
+                                      use_processes=self.args.save_processes)
+        # the batch sampler is deterministic, so it yields the dataset indices of
+        # the loader's batches in the same order
+        batch_indices = list(self.val_loader.batch_sampler)
+        next_log = (num_samples // self.args.log_every + 1) * self.args.log_every
+        try:
+            for indices, (image, target, filename, sizes) in zip(batch_indices, self.val_loader):
+                image = image.to(self.device)
+                target = target.to(self.device)
+
+                with torch.no_grad():
+                    outputs = self.predict(model, image)
+                # padded batches are cropped back per sample, so the metric skips
+                # the padding; the logits only match batch size 1 if nothing was padded
+                self.metric.update(unpad(outputs, sizes), unpad(target, sizes))
+                if self.condition_metric is not None:
+                    self.condition_metric.update(unpad(outputs, sizes), unpad(target, sizes),
+                                                 [self.condition_of(name) for name in filename])
+                num_samples += len(filename)
+                # get() syncs the device, so the running result is only logged
+                # every --log-every samples
+                if num_samples >= next_log:
+                    pixAcc, mIoU = self.metric.get()
+                    logger.info("Sample: {:d}, validation pixAcc: {:.3f}, mIoU: {:.3f}".format(
+                        num_samples, pixAcc * 100, mIoU * 100))
+                    next_log = (num_samples // self.args.log_every + 1) * self.args.log_every
+
+                if writer is not None:
+                    pred = outputs if self.args.output_labels else torch.argmax(outputs, 1)
+                    pred = pred.cpu().data.numpy()
+
+                    for predict, name, (h, w) in zip(pred, filename, sizes):
+                        writer.submit(predict[:h, :w], os.path.join(
+                            outdir, os.path.splitext(name)[0] + '.png'))
+                if self.eval_state is not None:
+                    self.eval_state.step(indices, metrics,
+                                         flush=writer.flush if writer is not None else None)
+        except BaseException:
+            # flush pending writes even if evaluation is interrupted, without
+            # replacing the original error by a failed write
+            if writer is not None:
+                writer.close(raise_error=False)
+            raise
+        if writer is not None:
+            writer.close()
+        if self.eval_state is not None:
+            self.eval_state.save(metrics)
+        # per-sample logs above are rank-local; merge the confusion matrices of
+        # all ranks for the global result
+        self.metric.confusion_matrix = all_reduce_sum(self.metric.confusion_matrix.to(self.device))
+        pixAcc, mIoU = self.metric.get()
+        logger.info("Whole validation set pixAcc: {:.3f}, mIoU: {:.3f}".format(pixAcc * 100, mIoU * 100))
+        if self.condition_metric is not None:
+            metric = self.condition_metric
+            metric.set_conditions(sorted(set().union(*all_gather(metric.conditions)), key=str))
+            metric.confusion_matrix = all_reduce_sum(metric.confusion_matrix.to(self.device))
+            logger.info("Per-condition IoU:\n{}".format(metric.table()))
 
         synchronize()
 
 
-if __name__ == '__main__':
+    def tta_report(self, scale_sets):
+        """Logs latency, pixAcc and mIoU of every TTA scale set on the val set."""
+        self.model.eval()
+        model = self.model.module if self.args.distributed else self.model
+        if self.inference_model is not None:
+            model = self.inference_model
+        report = tta_cost_report(model, self.val_loader, scale_sets, self.metric.nclass,
+                                 flip=self.args.tta_flip, device=self.device)
+        logger.info("TTA cost report:\n{}".format(report))
+
+    def quantize(self, output, num_batches):
+        """Calibrates an INT8 copy of the model on val batches, saves it to ``output``
+        and logs fp32 vs. INT8 latency and accuracy on the val set."""
+        self.model.eval()
+        model = self.model.module if self.args.distributed else self.model
+        quantized = quantize_int8(model, self.val_loader, num_batches=num_batches,
+                                  backend=self.args.quant_backend)
+        torch.save(quantized.state_dict(), output)
+        logger.info("Saved INT8 model to {}".format(output))
+        report = int8_cost_report(model, quantized, self.val_loader, self.metric.nclass)
+        logger.info("INT8 cost report:\n{}".format(report))
+
+
+def parse_eval_args():
+    """Evaluation-only options, parsed ahead of the shared training arguments."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--eval-batch-size', type=int, default=1,
+                        help='number of images per forward pass during evaluation; '
+                             'images are batched with images of the same size')
+    parser.add_argument('--log-every', type=int, default=100,
+                        help='number of samples between two logs of the running pixAcc and mIoU')
+    parser.add_argument('--save-workers', type=int, default=2,
+                        help='number of background workers writing predictions')
+    parser.add_argument('--save-processes', action='store_true', default=False,
+                        help='write predictions from worker processes instead of threads')
+    parser.add_argument('--tile-size', type=int, nargs='+', default=None,
+                        help='run sliding-window inference with tiles of this size (H [W])')
+    parser.add_argument('--tile-overlap', type=int, default=None,
+                        help='overlap between neighbouring tiles in pixels, '
+                             'defaults to a quarter of the tile size')
+    parser.add_argument('--tile-blend', type=str, default='mean', choices=['mean', 'gaussian'],
+                        help='how overlapping tiles are blended')
+    parser.add_argument('--tta-scales', type=float, nargs='+', default=None,
+                        help='input scales of multi-scale test-time augmentation')
+    parser.add_argument('--tta-flip', action='store_true', default=False,
+                        help='add horizontally flipped inputs to test-time augmentation')
+    parser.add_argument('--tta-report', type=str, nargs='+', default=None,
+                        help='comma-separated scale sets, e.g. "1.0" "0.75,1.0,1.25"; '
+                             'reports latency and mIoU of each instead of evaluating')
+    parser.add_argument('--output-labels', action='store_true', default=False,
+                        help='let the model return labels through a banded upsample+argmax '
+                             'instead of full-resolution logits')
+    parser.add_argument('--quantize', type=str, default=None, metavar='OUTPUT',
+                        help='calibrate an INT8 model on the val set, save it to OUTPUT and '
+                             'report its mIoU delta and CPU speedup instead of evaluating')
+    parser.add_argument('--calib-batches', type=int, default=50,
+                        help='number of val batches used to calibrate the INT8 observers')
+    parser.add_argument('--int8', action='store_true', default=False,
+                        help='--weights is an INT8 checkpoint saved by --quantize; runs on the CPU')
+    parser.add_argument('--quant-backend', type=str, default='x86',
+                        choices=['x86', 'fbgemm', 'qnnpack', 'onednn'],
+                        help='quantized engine used for INT8 inference')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='run inference on channels-last (NHWC) weights and inputs')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='compile the inference forward with torch.compile')
+    parser.add_argument('--compile-cache', type=str, default='./runs/compile_cache',
+                        help='persistent compile cache, so warm starts skip recompilation')
+    parser.add_argument('--amp', type=str, default=None, choices=['bf16', 'fp16'],
+                        help='run inference under bf16/fp16 autocast if it passes the accuracy check')
+    parser.add_argument('--amp-max-drop', type=float, default=0.5,
+                        help='largest mIoU drop (in points) against fp32 that --amp accepts')
+    parser.add_argument('--amp-check-batches', type=int, default=20,
+                        help='number of batches the --amp accuracy check runs on')
+    parser.add_argument('--amp-check-split', type=str, default='train',
+                        help='dataset split the --amp accuracy check draws its images from; '
+                             'keep it apart from the evaluated val split')
+    parser.add_argument('--condition-regex', type=str, default=None,
+                        help='also report IoU per condition, the first group of this regular '
+                             'expression in the image file name (e.g. the time of day)')
+    parser.add_argument('--condition-index', type=str, default=None,
+                        help='JSON file mapping image file names to condition tags; '
+                             'takes precedence over --condition-regex')
+    parser.add_argument('--eval-state', type=str, default=None,
+                        help='checkpoint the metric and the scored samples to this file, and '
+                             'resume from it if it exists')
+    parser.add_argument('--eval-state-every', type=int, default=50,
+                        help='number of scored samples between two --eval-state checkpoints')
+    parser.add_argument('--weights', type=str,
+                        default='./trained_models/ddrnet_23_dualresnet_citys_best_model.pth',
+                        help='trained model checkpoint to evaluate')
+    eval_args, remaining = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + remaining
     args = parse_args()
+    for key, value in vars(eval_args).items():
+        setattr(args, key, value)
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_eval_args()
     num_gpus = int(os.environ["WORLD_SIZE"]
                    ) if "WORLD_SIZE" in os.environ else 1
     args.distributed = num_gpus > 1
-    if not args.no_cuda and torch.cuda.is_available():
+    # quantized kernels only exist for the CPU
+    if not args.no_cuda and torch.cuda.is_available() and not args.int8:
         cudnn.benchmark = True
         args.device = "cuda"
     else:
@@ -124,5 +384,10 @@ if __name__ == '__main__':
                           filename='{}_{}_{}_log.txt'.format(args.model, args.backbone, args.dataset), mode='a+')
 
     evaluator = Evaluator(args)
-    evaluator.eval()
+    if args.quantize:
+        evaluator.quantize(args.quantize, args.calib_batches)
+    elif args.tta_report:
+        evaluator.tta_report([[float(s) for s in scales.split(',')] for scales in args.tta_report])
+    else:
+        evaluator.eval()
     torch.cuda.empty_cache()
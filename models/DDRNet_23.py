@@ -5,6 +5,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import init
 from collections import OrderedDict
+from functools import partial
+from torch.utils.hooks import RemovableHandle
+
+from .checkpoint import load_pretrained, skip_init
+from .ops import (upsample_argmax, cached_context, submit_branch, checkpoint_stage,
+                  resolve_checkpoint_stages)
 
 BatchNorm2d = nn.BatchNorm2d
 bn_mom = 0.1
@@ -159,6 +165,8 @@ class DAPPM(nn.Module):
             nn.ReLU(inplace=True),
             nn.Conv2d(inplanes, outplanes, kernel_size=1, bias=False),
         )
+        # run the pooled scales concurrently, see ops.set_parallel_branches
+        self.parallel_branches = False
 
     def forward(self, x):
 
@@ -167,17 +175,25 @@ class DAPPM(nn.Module):
         height = x.shape[-2]
         x_list = []
 
-        x_list.append(self.scale0(x))
-        x_list.append(self.process1((F.interpolate(self.scale1(x),
+        scales = (self.scale1, self.scale2, self.scale3, self.scale4)
+        if self.parallel_branches:
+            pooled = [submit_branch(scale, x) for scale in scales]
+            x_list.append(self.scale0(x))
+            pooled = [p.result() for p in pooled]
+        else:
+            x_list.append(self.scale0(x))
+            pooled = [scale(x) for scale in scales]
+
+        x_list.append(self.process1((F.interpolate(pooled[0],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[0])))
-        x_list.append((self.process2((F.interpolate(self.scale2(x),
+        x_list.append((self.process2((F.interpolate(pooled[1],
                                                     size=[height, width],
                                                     mode='bilinear')+x_list[1]))))
-        x_list.append(self.process3((F.interpolate(self.scale3(x),
+        x_list.append(self.process3((F.interpolate(pooled[2],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[2])))
-        x_list.append(self.process4((F.interpolate(self.scale4(x),
+        x_list.append(self.process4((F.interpolate(pooled[3],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[3])))
 
@@ -224,7 +240,7 @@ class segmenthead(nn.Module):
             nn.ReLU(inplace=True),
         )
 
-    def forward(self, C, A):
+    def forward(self, C, A, with_aux=True):
         
         attention_c=self.conv3(C)
         attention_a=self.conv4(A)
@@ -235,8 +251,11 @@ class segmenthead(nn.Module):
         x = self.conv1(self.relu(self.bn1(C_+A_)))
         out = self.conv2(self.relu(self.bn2(x)))
         
-        Cupdate=self.conv5(C)
-        C_update=self.conv6(C_)
+        # C_update/Cupdate only feed the training losses
+        Cupdate, C_update = None, None
+        if with_aux:
+            Cupdate=self.conv5(C)
+            C_update=self.conv6(C_)
 
         if self.scale_factor is not None:
             height = x.shape[-2] * self.scale_factor
@@ -277,12 +296,32 @@ class segmentheadold(nn.Module):
 
 
 class DualResNet(nn.Module):
-
-    def __init__(self, block, layers, num_classes=19, planes=64, spp_planes=128, head_planes=128, augment=False):
+    # intermediate features that register_feature_tap can expose
+    feature_tap_names = ('before_I', 'after_I', 'before_E', 'after_E')
+    # stages that can recompute their activations in backward, see checkpoint_stages
+    checkpointable_stages = ('conv1', 'layer1', 'layer2', 'layer3', 'layer3_', 'layer4', 'layer4_',
+                             'layer5', 'layer5_', 'spp', 'final_layer', 'seghead_extra')
+
+    def __init__(self, block, layers, num_classes=19, planes=64, spp_planes=128, head_planes=128, augment=False,
+                 checkpoint_stages=()):
         super(DualResNet, self).__init__()
 
         highres_planes = planes * 2
         self.augment = augment
+        # return N x H x W labels instead of full-resolution logits
+        self.output_labels = False
+        # only return the segmentation output and skip every auxiliary tensor
+        self.inference_only = False
+        # run the low- and high-resolution branches concurrently, see ops.set_parallel_branches
+        self.parallel_branches = False
+        # cache the low-resolution context in context_cache and reuse it on the next
+        # calls instead of recomputing it, see utils.inference.StreamingInference
+        self.reuse_context = False
+        self.context_cache = None
+        # hooks of register_feature_tap; the forward only checks this is empty
+        self._feature_taps = OrderedDict()
+        # return None right after the feature taps, skipping the segmentation head
+        self.features_only = False
 
         self.conv1 = nn.Sequential(
             nn.Conv2d(3, planes, kernel_size=3, stride=2, padding=1),
@@ -355,6 +394,56 @@ class DualResNet(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
+        # stage names (or True for all) whose activations are recomputed in backward
+        # instead of stored, trading step time for training memory
+        self.checkpoint_stages = resolve_checkpoint_stages(self, checkpoint_stages)
+
+    def _stage(self, name, *args, **kwargs):
+        return checkpoint_stage(getattr(self, name), *args,
+                                enabled=name in self.checkpoint_stages, **kwargs)
+
+    def register_feature_tap(self, name, hook, channels=None):
+        """Calls ``hook(features)`` with an intermediate feature map on every forward.
+
+        Parameters
+        ----------
+        name : str
+            ``'before_I'``/``'after_I'``: the upsampled context branch before and
+            after DAPPM; ``'before_E'``/``'after_E'``: the appearance branch before
+            and after ``layer5_``. All are at 1/8 of the input resolution.
+        hook : callable
+            Receives the N x K x H/8 x W/8 features; its return value is ignored.
+        channels : sequence of int, optional
+            Channels to keep, gathered with one ``index_select``. All by default.
+
+        Returns
+        -------
+        RemovableHandle
+            ``handle.remove()`` unregisters the tap.
+        """
+        if name not in self.feature_tap_names:
+            raise ValueError("unknown feature tap {!r}, expected one of {}".format(
+                name, list(self.feature_tap_names)))
+        index = None if channels is None else torch.as_tensor(channels, dtype=torch.long, device='cpu')
+        handle = RemovableHandle(self._feature_taps)
+        self._feature_taps[handle.id] = (name, hook, index)
+        return handle
+
+    def _tapped(self, name):
+        return any(tap[0] == name for tap in self._feature_taps.values())
+
+    def _tap(self, name, features):
+        for key, (tap_name, hook, index) in self._feature_taps.items():
+            if tap_name != name:
+                continue
+            if index is None:
+                hook(features)
+                continue
+            if index.device != features.device:
+                index = index.to(features.device)
+                self._feature_taps[key] = (tap_name, hook, index)
+            hook(features.index_select(1, index))
+
     def _make_layer(self, block, inplanes, planes, blocks, stride=1):
         downsample = None
         if stride != 1 or inplanes != planes * block.expansion:
@@ -375,6 +464,21 @@ class DualResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def _context_branch(self, x, height_output, width_output):
+        ### low resolution 1/64 branch, need upsampling, content branch
+        x = self._stage('layer5', self.relu(x))
+        before_I = None
+        if self._tapped('before_I'):
+            before_I = F.interpolate(
+                x,
+                size=[height_output, width_output],
+                mode='bilinear')
+        x = F.interpolate(
+            self._stage('spp', x),
+            size=[height_output, width_output],
+            mode='bilinear')
+        return before_I, x
+
     def forward(self, x):
 
         width_output_or = x.shape[-1]
@@ -384,103 +488,123 @@ class DualResNet(nn.Module):
         height_output = x.shape[-2] // 8
         layers = []
 
-        x = self.conv1(x)
+        x = self._stage('conv1', x)
 
-        x = self.layer1(x)
+        x = self._stage('layer1', x)
         layers.append(x)
 
-        x = self.layer2(self.relu(x))
+        x = self._stage('layer2', self.relu(x))
         layers.append(x)
 
-        x = self.layer3(self.relu(x))
+        x = self._stage('layer3', self.relu(x))
         layers.append(x)
         
-        x_ = self.layer3_(self.relu(layers[1]))  #### [4,128,128,128]
+        x_ = self._stage('layer3_', self.relu(layers[1]))  #### [4,128,128,128]
 
-        x = x + self.down3(self.relu(x_)) ###[4,256,64,64]
+        # down3, layer4 -> layer5 -> DAPPM and the compression4 term are taken from the cache
+        cache = cached_context(self, x.shape[0], height_output, width_output)
+        reuse = cache is not None
+        if not reuse:
+            x = x + self.down3(self.relu(x_)) ###[4,256,64,64]
         
         x_ = x_ + F.interpolate(
             self.compression3(self.relu(layers[2])),
             size=[height_output, width_output],
             mode='bilinear')   ###[4,128,64,64]
         
-        if self.augment:
+        if self.augment and not self.inference_only:
             temp = x_
 
-        x = self.layer4(self.relu(x))
-        layers.append(x)
-        x_ = self.layer4_(self.relu(x_))
+        if not reuse:
+            x = self._stage('layer4', self.relu(x))
+            layers.append(x)
+        x_ = self._stage('layer4_', self.relu(x_))
 
-        x = x + self.down4(self.relu(x_))
-        x_ = x_ + F.interpolate(
-            self.compression4(self.relu(layers[3])),
-            size=[height_output, width_output],
-            mode='bilinear')   ###[4,128,128,128]
+        if reuse:
+            compressed, context = cache
+        else:
+            x = x + self.down4(self.relu(x_))
+            compressed = F.interpolate(
+                self.compression4(self.relu(layers[3])),
+                size=[height_output, width_output],
+                mode='bilinear')   ###[4,128,128,128]
+        x_ = x_ + compressed
+
+        # the two branches below are independent until final_layer
+        if self.parallel_branches and not reuse:
+            context = submit_branch(
+                self._context_branch, x, height_output, width_output)
 
         ### high-resolution 1/8  apperance branch     
-        before_E = x_
-        x_ = self.layer5_(self.relu(x_))
-        x_a = x_   ###[4,256,128,128]
-        after_E = x_
+        if self._feature_taps:
+            self._tap('before_E', x_)
+        x_ = self._stage('layer5_', self.relu(x_))   ###[4,256,128,128]
+        if self._feature_taps:
+            self._tap('after_E', x_)
         
-         ### low resolution 1/64 branch, need upsampling, content branch
-        x = self.layer5(self.relu(x))
-        before_I = F.interpolate(
-            x,
-            size=[height_output, width_output],
-            mode='bilinear')
-        x = F.interpolate(
-            self.spp(x),
-            size=[height_output, width_output],
-            mode='bilinear')
-        x_c = x   ###[4,256,128,128]
-        after_I = x
-
-        x_, C, C_ = self.final_layer(x, x_)  ### seghead [4,19,128,128]
+        if not reuse:
+            if self.parallel_branches:
+                context = context.result()
+            else:
+                context = self._context_branch(x, height_output, width_output)
+            if self.reuse_context:
+                self.context_cache = (compressed, context)
+        before_I, x = context   ###[4,256,128,128]
+        if self._feature_taps:
+            if before_I is not None:
+                self._tap('before_I', before_I)
+            self._tap('after_I', x)
+        if self.features_only:
+            return None
+
+        x_, C, C_ = self._stage('final_layer', x, x_, with_aux=not self.inference_only)  ### seghead [4,19,128,128]
 
         outputs = []
 
-        x_ = F.interpolate(x_,
-                           size=[height_output_or, width_output_or],
-                           mode='bilinear', align_corners=True)   #[4,19,1024,1024]
+        if self.output_labels and (self.inference_only or not self.augment):
+            x_ = upsample_argmax(x_, (height_output_or, width_output_or))
+        else:
+            x_ = F.interpolate(x_,
+                               size=[height_output_or, width_output_or],
+                               mode='bilinear', align_corners=True)   #[4,19,1024,1024]
         
         outputs.append(x_)
 
-        if self.augment:
-            x_extra = self.seghead_extra(temp)
+        if self.inference_only:
+            return tuple(outputs)
+        elif self.augment:
+            x_extra = self._stage('seghead_extra', temp)
             return [x_, x_extra]
         else:
             return tuple(outputs), C_, C 
 
 
-def DualResNet_imagenet(pretrained=True):
-    model = DualResNet(BasicBlock, [2, 2, 2, 2], num_classes=19,
-                       planes=64, spp_planes=128, head_planes=128, augment=False)
+def DualResNet_imagenet(pretrained=True, pretrained_path="D:/DDR/models/DDRNet23_imagenet.pth", **kwargs):
+    # pretrained weights overwrite the random init, so skip it
+    with skip_init(pretrained):
+        model = DualResNet(BasicBlock, [2, 2, 2, 2], num_classes=19,
+                           planes=64, spp_planes=128, head_planes=128, augment=False, **kwargs)
     if pretrained:
-        pretrained_state = torch.load(
-            "D:/DDR/models/DDRNet23_imagenet.pth", map_location='cpu')
-        model_dict = model.state_dict()
-        pretrained_state = {k: v for k, v in pretrained_state.items() if
-                            (k in model_dict and v.shape == model_dict[k].shape)}
-        model_dict.update(pretrained_state)
-
-        model.load_state_dict(model_dict, strict=False)
+        load_pretrained(model, pretrained_path)
         print("Having loaded imagenet-pretrained weights successfully!")
 
     return model
 
 
-def get_ddrnet_23(pretrained=True):
+def get_ddrnet_23(pretrained=True, **kwargs):
 
-    model = DualResNet_imagenet(pretrained=pretrained)
+    model = DualResNet_imagenet(pretrained=pretrained, **kwargs)
     return model
 
 
 ### C-leaner & A-learner later part
 
 class CAinteract(nn.Module):
+    # stages that can recompute their activations in backward, see checkpoint_stages
+    checkpointable_stages = ('conv1', 'conv2', 'final_layer')
 
-    def __init__(self, num_classes=19, planes=64, spp_planes=128, head_planes=128, augment=False):
+    def __init__(self, num_classes=19, planes=64, spp_planes=128, head_planes=128, augment=False,
+                 checkpoint_stages=()):
         super(CAinteract, self).__init__()
 
         self.augment = augment
@@ -523,6 +647,13 @@ class CAinteract(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
+        # stage names (or True for all) whose activations are recomputed in backward
+        self.checkpoint_stages = resolve_checkpoint_stages(self, checkpoint_stages)
+
+    def _stage(self, name, *args, **kwargs):
+        return checkpoint_stage(getattr(self, name), *args,
+                                enabled=name in self.checkpoint_stages, **kwargs)
+
     def _make_layer(self, block, inplanes, planes, blocks, stride=1):
         downsample = None
         if stride != 1 or inplanes != planes * block.expansion:
@@ -543,19 +674,24 @@ class CAinteract(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, X_, C, A):
+    def forward(self, X_, C, A, size=None):
 
         # layers = []
-        height_output=1024
-        width_output=1024
+        # C and A are 1/8 resolution features; predict at the input resolution
+        # unless an explicit output size is given
+        if size is None:
+            size = (C.shape[-2] * 8, C.shape[-1] * 8)
+        height_output, width_output = size
 
-        attention_c = self.conv1(C)
-        attention_a = self.conv2(A)
+        attention_c = self._stage('conv1', C)
+        attention_a = self._stage('conv2', A)
 
         C=C*attention_c+C
         A=A*attention_a+A
         
-        x_ = self.final_layer(2*X_+ C + A)  ### seghead [4,19,128,128]
+        # with S = C + A, segmenthead fuses 2*X_ + att_x*X_ + S*att_x + S + att_s*S,
+        # att_x = conv3(X_) and att_s = conv4(S), before its bn1 -> conv1
+        x_, _, _ = self._stage('final_layer', X_, C + A, with_aux=False)  ### seghead [4,19,128,128]
 
         outputs = []
 
@@ -571,8 +707,11 @@ class CAinteract(nn.Module):
 ### C-A merge module
 
 class CAmerge(nn.Module):
+    # stages that can recompute their activations in backward, see checkpoint_stages;
+    # conv2 and conv3 include the upsampling in front of them
+    checkpointable_stages = ('conv1', 'conv2', 'conv3')
 
-    def __init__(self, planes=64, augment=False):
+    def __init__(self, planes=64, augment=False, checkpoint_stages=()):
         super(CAmerge, self).__init__()
 
         highres_planes = planes * 2
@@ -619,37 +758,45 @@ class CAmerge(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
-    def forward(self, C, A):
+        # stage names (or True for all) whose activations are recomputed in backward
+        self.checkpoint_stages = resolve_checkpoint_stages(self, checkpoint_stages)
+
+    def _stage(self, name, *args, **kwargs):
+        return checkpoint_stage(getattr(self, name), *args,
+                                enabled=name in self.checkpoint_stages, **kwargs)
+
+    def _upsample_refine(self, name, x, size):
+        # one stage, so the upsampled map is recomputed in backward instead of stored
+        x = F.interpolate(self.relu(x), size=size, mode='bilinear')
+        return getattr(self, name)(self.relu(x))
+
+    def forward(self, C, A, size=None):
 
         layers = []
+        # reconstruct at 8x the feature resolution unless an explicit size is given,
+        # e.g. a smaller one for a fast mode
+        if size is None:
+            size = (C.shape[-2] * 8, C.shape[-1] * 8)
+        height, width = size
 
         ### C and A are from 1/8 resolution, input for reconstruction   ###[4,256,128,128] -> [4,64,128,128] -> [4,64,256,256]
-        x = self.conv1(C+A)  
+        x = self._stage('conv1', C+A)  
         layers.append(x)
         ## upsample 128->256
-        x = F.interpolate(
-            self.relu(layers[0]),
-            size=[256,256],
-            mode='bilinear')
-
         ###[4,64,256,256] -> [4,32,256,256] -> [4,32,512,512]
-        x = self.conv2(self.relu(x))     
+        x = self._stage('conv2', layers[0], [height // 4, width // 4],
+                        fn=partial(self._upsample_refine, 'conv2'))
         # if x_41 has more channels than 64 (plane), then first need to add another layer to compress it to 64 channels
         layers.append(x)
         ## upsample 256->512
-        x = F.interpolate(
-            self.relu(layers[1]),
-            size=[512,512],
-            mode='bilinear')
-        
         ###[4,32,512,512] -> [4,3,512,512] -> [4,3,1024,1024]
-
-        x = self.conv3(self.relu(x))
+        x = self._stage('conv3', layers[1], [height // 2, width // 2],
+                        fn=partial(self._upsample_refine, 'conv3'))
         layers.append(x)
         
         x = F.interpolate(
             self.relu(layers[2]),
-            size=[1024, 1024],
+            size=[height, width],
             mode='bilinear')   ###[4,128,64,64]
         
         if self.augment:
@@ -665,12 +812,12 @@ class CAmerge(nn.Module):
         else:
             return tuple(outputs), x
 
-def get_CA_interact( ):
-    model = CAinteract( )
+def get_CA_interact(**kwargs):
+    model = CAinteract(**kwargs)
     return model
 
-def get_CA_merge( ):
-    model = CAmerge( )
+def get_CA_merge(**kwargs):
+    model = CAmerge(**kwargs)
     return model
 
 if __name__ == "__main__":
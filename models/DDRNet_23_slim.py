@@ -7,6 +7,10 @@ from torch.nn import init
 import torch
 from collections import OrderedDict
 
+from .checkpoint import load_pretrained, skip_init
+from .ops import (upsample_argmax, cached_context, submit_branch, checkpoint_stage,
+                  resolve_checkpoint_stages)
+
 BatchNorm2d = nn.BatchNorm2d
 bn_mom = 0.1
 
@@ -160,6 +164,8 @@ class DAPPM(nn.Module):
             nn.ReLU(inplace=True),
             nn.Conv2d(inplanes, outplanes, kernel_size=1, bias=False),
         )
+        # run the pooled scales concurrently, see ops.set_parallel_branches
+        self.parallel_branches = False
 
     def forward(self, x):
 
@@ -168,17 +174,25 @@ class DAPPM(nn.Module):
         height = x.shape[-2]
         x_list = []
 
-        x_list.append(self.scale0(x))
-        x_list.append(self.process1((F.interpolate(self.scale1(x),
+        scales = (self.scale1, self.scale2, self.scale3, self.scale4)
+        if self.parallel_branches:
+            pooled = [submit_branch(scale, x) for scale in scales]
+            x_list.append(self.scale0(x))
+            pooled = [p.result() for p in pooled]
+        else:
+            x_list.append(self.scale0(x))
+            pooled = [scale(x) for scale in scales]
+
+        x_list.append(self.process1((F.interpolate(pooled[0],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[0])))
-        x_list.append((self.process2((F.interpolate(self.scale2(x),
+        x_list.append((self.process2((F.interpolate(pooled[1],
                                                     size=[height, width],
                                                     mode='bilinear')+x_list[1]))))
-        x_list.append(self.process3((F.interpolate(self.scale3(x),
+        x_list.append(self.process3((F.interpolate(pooled[2],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[2])))
-        x_list.append(self.process4((F.interpolate(self.scale4(x),
+        x_list.append(self.process4((F.interpolate(pooled[3],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[3])))
 
@@ -215,12 +229,26 @@ class segmenthead(nn.Module):
 
 
 class DualResNet(nn.Module):
+    # stages that can recompute their activations in backward, see checkpoint_stages
+    checkpointable_stages = ('conv1', 'layer1', 'layer2', 'layer3', 'layer3_', 'layer4', 'layer4_',
+                             'layer5', 'layer5_', 'spp', 'final_layer')
 
-    def __init__(self, block, layers, num_classes=19, planes=64, spp_planes=128, head_planes=128, augment=False):
+    def __init__(self, block, layers, num_classes=19, planes=64, spp_planes=128, head_planes=128, augment=False,
+                 checkpoint_stages=()):
         super(DualResNet, self).__init__()
 
         highres_planes = planes * 2
         self.augment = augment
+        # return N x H x W labels instead of full-resolution logits
+        self.output_labels = False
+        # only return the segmentation output and skip every auxiliary tensor
+        self.inference_only = False
+        # run the low- and high-resolution branches concurrently, see ops.set_parallel_branches
+        self.parallel_branches = False
+        # cache the low-resolution context in context_cache and reuse it on the next
+        # calls instead of recomputing it, see utils.inference.StreamingInference
+        self.reuse_context = False
+        self.context_cache = None
 
         self.conv1 = nn.Sequential(
             nn.Conv2d(3, planes, kernel_size=3, stride=2, padding=1),
@@ -293,6 +321,14 @@ class DualResNet(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
+        # stage names (or True for all) whose activations are recomputed in backward
+        # instead of stored, trading step time for training memory
+        self.checkpoint_stages = resolve_checkpoint_stages(self, checkpoint_stages)
+
+    def _stage(self, name, *args, **kwargs):
+        return checkpoint_stage(getattr(self, name), *args,
+                                enabled=name in self.checkpoint_stages, **kwargs)
+
     def _make_layer(self, block, inplanes, planes, blocks, stride=1):
         downsample = None
         if stride != 1 or inplanes != planes * block.expansion:
@@ -313,6 +349,13 @@ class DualResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def _context_branch(self, x, height_output, width_output):
+        ### low resolution 1/64 branch, need upsampling, content branch
+        return F.interpolate(
+            self._stage('spp', self._stage('layer5', self.relu(x))),
+            size=[height_output, width_output],
+            mode='bilinear')
+
     def forward(self, x):
         width_output_or = x.shape[-1]
         height_output_or = x.shape[-2]
@@ -321,20 +364,24 @@ class DualResNet(nn.Module):
         height_output = x.shape[-2] // 8
         layers = []
 
-        x = self.conv1(x)
+        x = self._stage('conv1', x)
 
-        x = self.layer1(x)
+        x = self._stage('layer1', x)
         layers.append(x)
 
-        x = self.layer2(self.relu(x))
+        x = self._stage('layer2', self.relu(x))
         layers.append(x)
         
-        x = self.layer3(self.relu(x))
+        x = self._stage('layer3', self.relu(x))
         x_i=x
         layers.append(x)
-        x_ = self.layer3_(self.relu(layers[1]))
+        x_ = self._stage('layer3_', self.relu(layers[1]))
 
-        x = x + self.down3(self.relu(x_))
+        # down3, layer4 -> layer5 -> DAPPM and the compression4 term are taken from the cache
+        cache = cached_context(self, x.shape[0], height_output, width_output)
+        reuse = cache is not None
+        if not reuse:
+            x = x + self.down3(self.relu(x_))
         x_ = x_ + F.interpolate(
             self.compression3(self.relu(layers[2])),
             size=[height_output, width_output],
@@ -342,38 +389,56 @@ class DualResNet(nn.Module):
         if self.augment:
             temp = x_
 
-        x = self.layer4(self.relu(x))
-        layers.append(x)
-        x_ = self.layer4_(self.relu(x_))
+        if not reuse:
+            x = self._stage('layer4', self.relu(x))
+            layers.append(x)
+        x_ = self._stage('layer4_', self.relu(x_))
 
-        x = x + self.down4(self.relu(x_))
-        x_ = x_ + F.interpolate(
-            self.compression4(self.relu(layers[3])),
-            size=[height_output, width_output],
-            mode='bilinear')
+        if reuse:
+            compressed, context = cache
+        else:
+            x = x + self.down4(self.relu(x_))
+            compressed = F.interpolate(
+                self.compression4(self.relu(layers[3])),
+                size=[height_output, width_output],
+                mode='bilinear')
+        x_ = x_ + compressed
+
+        # the two branches below are independent until final_layer
+        if self.parallel_branches and not reuse:
+            context = submit_branch(
+                self._context_branch, x, height_output, width_output)
 
         ### high resolution 1/8 branch,  apperance branch
-        x_ = self.layer5_(self.relu(x_))
+        x_ = self._stage('layer5_', self.relu(x_))
         x_a =x_
         
-        ### low resolution 1/64 branch, need upsampling, content branch
-        x = F.interpolate(
-            self.spp(self.layer5(self.relu(x))),
-            size=[height_output, width_output],
-            mode='bilinear')
+        if not reuse:
+            if self.parallel_branches:
+                context = context.result()
+            else:
+                context = self._context_branch(x, height_output, width_output)
+            if self.reuse_context:
+                self.context_cache = (compressed, context)
+        x = context
         x_c = x
 
-        x_ = self.final_layer(x + x_)
+        x_ = self._stage('final_layer', x + x_)
 
         outputs = []
         outputs_c=[]
         outputs_a=[]
         outputs_i=[]
 
-        x_ = F.interpolate(x_,
-                           size=[height_output_or, width_output_or],
-                           mode='bilinear', align_corners=True)
+        if self.output_labels and (self.inference_only or not self.augment):
+            x_ = upsample_argmax(x_, (height_output_or, width_output_or))
+        else:
+            x_ = F.interpolate(x_,
+                               size=[height_output_or, width_output_or],
+                               mode='bilinear', align_corners=True)
         outputs.append(x_)
+        if self.inference_only:
+            return tuple(outputs)
         
         
         x_c = F.interpolate(x_c,
@@ -393,7 +458,7 @@ class DualResNet(nn.Module):
 
         # if self.augment:
         #     assert 1 == 0
-        #     x_extra = self.seghead_extra(temp)
+        #     x_extra = self._stage('seghead_extra', temp)
         #     return [x_, x_extra]
         # else:
         #     #return tuple(outputs), tuple(outputs_c), tuple(outputs_a), tuple(outputs_i)
@@ -404,36 +469,22 @@ class DualResNet(nn.Module):
         #return outputs, outputs_c ,outputs_a, outputs_i
 
 
-def DualResNet_imagenet(pretrained=False):
+def DualResNet_imagenet(pretrained=False, pretrained_path="D:/DDR/models/DDRNet23s_imagenet.pth", **kwargs):
     #model, C, A, I = DualResNet(BasicBlock, [2, 2, 2, 2], num_classes=19,
     #                   planes=32, spp_planes=128, head_planes=64, augment=False)
-    model = DualResNet(BasicBlock, [2, 2, 2, 2], num_classes=19,
-                       planes=32, spp_planes=128, head_planes=64, augment=False)
+    # pretrained weights overwrite the random init, so skip it
+    with skip_init(pretrained):
+        model = DualResNet(BasicBlock, [2, 2, 2, 2], num_classes=19,
+                           planes=32, spp_planes=128, head_planes=64, augment=False, **kwargs)
     if pretrained:
-        # remove hardcoded path by user provided path
-        checkpoint = torch.load(
-            "D:/DDR/models/DDRNet23s_imagenet.pth", map_location='cpu')
-
-        new_state_dict = OrderedDict()
-        model_dict = model.state_dict()
-
-        for existing_key, _ in model_dict.items():
-            for k, v in checkpoint.items():
-                if existing_key == k:
-                    name = k[7:]
-                    new_state_dict[k] = v
-        model_dict.update(new_state_dict)
-        model.load_state_dict(model_dict)
-
+        load_pretrained(model, pretrained_path)
         print("Having loaded imagenet-pretrained successfully!")
-
-        # model.load_state_dict(new_state_dict, strict=False)
     return model#, C, A, I
 
 
-def get_ddrnet_23_slim(pretrained=True):
+def get_ddrnet_23_slim(pretrained=True, **kwargs):
 
-    model = DualResNet_imagenet(pretrained=pretrained)
+    model = DualResNet_imagenet(pretrained=pretrained, **kwargs)
     return model
 
 
@@ -7,6 +7,10 @@ import torch.nn.functional as F
 from torch.nn import init
 from collections import OrderedDict
 
+from .checkpoint import load_pretrained, skip_init
+from .ops import (upsample_argmax, cached_context, submit_branch, checkpoint_stage,
+                  resolve_checkpoint_stages)
+
 # for single gpu
 BatchNorm2d = nn.BatchNorm2d
 bn_mom = 0.1
@@ -162,6 +166,8 @@ class DAPPM(nn.Module):
             nn.ReLU(inplace=True),
             nn.Conv2d(inplanes, outplanes, kernel_size=1, bias=False),
         )
+        # run the pooled scales concurrently, see ops.set_parallel_branches
+        self.parallel_branches = False
 
     def forward(self, x):
 
@@ -170,17 +176,25 @@ class DAPPM(nn.Module):
         height = x.shape[-2]
         x_list = []
 
-        x_list.append(self.scale0(x))
-        x_list.append(self.process1((F.interpolate(self.scale1(x),
+        scales = (self.scale1, self.scale2, self.scale3, self.scale4)
+        if self.parallel_branches:
+            pooled = [submit_branch(scale, x) for scale in scales]
+            x_list.append(self.scale0(x))
+            pooled = [p.result() for p in pooled]
+        else:
+            x_list.append(self.scale0(x))
+            pooled = [scale(x) for scale in scales]
+
+        x_list.append(self.process1((F.interpolate(pooled[0],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[0])))
-        x_list.append((self.process2((F.interpolate(self.scale2(x),
+        x_list.append((self.process2((F.interpolate(pooled[1],
                                                     size=[height, width],
                                                     mode='bilinear')+x_list[1]))))
-        x_list.append(self.process3((F.interpolate(self.scale3(x),
+        x_list.append(self.process3((F.interpolate(pooled[2],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[2])))
-        x_list.append(self.process4((F.interpolate(self.scale4(x),
+        x_list.append(self.process4((F.interpolate(pooled[3],
                                                    size=[height, width],
                                                    mode='bilinear')+x_list[3])))
 
@@ -217,12 +231,27 @@ class segmenthead(nn.Module):
 
 
 class DualResNet(nn.Module):
+    # stages that can recompute their activations in backward, see checkpoint_stages
+    checkpointable_stages = ('conv1', 'layer1', 'layer2', 'layer3_1', 'layer3_1_', 'layer3_2', 'layer3_2_',
+                             'layer4', 'layer4_', 'layer5', 'layer5_', 'spp', 'final_layer',
+                             'seghead_extra')
 
-    def __init__(self, block, layers, num_classes=19, planes=64, spp_planes=128, head_planes=128, augment=False):
+    def __init__(self, block, layers, num_classes=19, planes=64, spp_planes=128, head_planes=128, augment=False,
+                 checkpoint_stages=()):
         super(DualResNet, self).__init__()
 
         highres_planes = planes * 2
         self.augment = augment
+        # return N x H x W labels instead of full-resolution logits
+        self.output_labels = False
+        # only return the segmentation output and skip every auxiliary tensor
+        self.inference_only = False
+        # run the low- and high-resolution branches concurrently, see ops.set_parallel_branches
+        self.parallel_branches = False
+        # cache the low-resolution context in context_cache and reuse it on the next
+        # calls instead of recomputing it, see utils.inference.StreamingInference
+        self.reuse_context = False
+        self.context_cache = None
 
         self.conv1 = nn.Sequential(
             nn.Conv2d(3, planes, kernel_size=3, stride=2, padding=1),
@@ -312,6 +341,14 @@ class DualResNet(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
+        # stage names (or True for all) whose activations are recomputed in backward
+        # instead of stored, trading step time for training memory
+        self.checkpoint_stages = resolve_checkpoint_stages(self, checkpoint_stages)
+
+    def _stage(self, name, *args, **kwargs):
+        return checkpoint_stage(getattr(self, name), *args,
+                                enabled=name in self.checkpoint_stages, **kwargs)
+
     def _make_layer(self, block, inplanes, planes, blocks, stride=1):
         downsample = None
         if stride != 1 or inplanes != planes * block.expansion:
@@ -332,6 +369,12 @@ class DualResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def _context_branch(self, x, height_output, width_output):
+        return F.interpolate(
+            self._stage('spp', self._stage('layer5', self.relu(x))),
+            size=[height_output, width_output],
+            mode='bilinear')
+
     def forward(self, x):
 
         width_output_or = x.shape[-1]
@@ -341,27 +384,31 @@ class DualResNet(nn.Module):
         height_output = x.shape[-2] // 8
         layers = []
 
-        x = self.conv1(x)
+        x = self._stage('conv1', x)
 
-        x = self.layer1(x)
+        x = self._stage('layer1', x)
         layers.append(x)
 
-        x = self.layer2(self.relu(x))
+        x = self._stage('layer2', self.relu(x))
         layers.append(x)
 
-        x = self.layer3_1(self.relu(x))
+        x = self._stage('layer3_1', self.relu(x))
         layers.append(x)
-        x_ = self.layer3_1_(self.relu(layers[1]))
+        x_ = self._stage('layer3_1_', self.relu(layers[1]))
         x = x + self.down3_1(self.relu(x_))
         x_ = x_ + F.interpolate(
             self.compression3_1(self.relu(layers[2])),
             size=[height_output, width_output],
             mode='bilinear')
 
-        x = self.layer3_2(self.relu(x))
+        x = self._stage('layer3_2', self.relu(x))
         layers.append(x)
-        x_ = self.layer3_2_(self.relu(x_))
-        x = x + self.down3_2(self.relu(x_))
+        x_ = self._stage('layer3_2_', self.relu(x_))
+        # down3_2, layer4 -> layer5 -> DAPPM and the compression4 term are taken from the cache
+        cache = cached_context(self, x.shape[0], height_output, width_output)
+        reuse = cache is not None
+        if not reuse:
+            x = x + self.down3_2(self.relu(x_))
         x_ = x_ + F.interpolate(
             self.compression3_2(self.relu(layers[3])),
             size=[height_output, width_output],
@@ -369,57 +416,67 @@ class DualResNet(nn.Module):
 
         temp = x_
 
-        x = self.layer4(self.relu(x))
-        layers.append(x)
-        x_ = self.layer4_(self.relu(x_))
-        x = x + self.down4(self.relu(x_))
-        x_ = x_ + F.interpolate(
-            self.compression4(self.relu(layers[4])),
-            size=[height_output, width_output],
-            mode='bilinear')
-
-        x_ = self.layer5_(self.relu(x_))
-        x = F.interpolate(
-            self.spp(self.layer5(self.relu(x))),
-            size=[height_output, width_output],
-            mode='bilinear')
+        if not reuse:
+            x = self._stage('layer4', self.relu(x))
+            layers.append(x)
+        x_ = self._stage('layer4_', self.relu(x_))
+        if reuse:
+            compressed, context = cache
+        else:
+            x = x + self.down4(self.relu(x_))
+            compressed = F.interpolate(
+                self.compression4(self.relu(layers[4])),
+                size=[height_output, width_output],
+                mode='bilinear')
+        x_ = x_ + compressed
+
+        # the two branches below are independent until final_layer
+        if self.parallel_branches and not reuse:
+            context = submit_branch(
+                self._context_branch, x, height_output, width_output)
+        x_ = self._stage('layer5_', self.relu(x_))
+        if not reuse:
+            if self.parallel_branches:
+                context = context.result()
+            else:
+                context = self._context_branch(x, height_output, width_output)
+            if self.reuse_context:
+                self.context_cache = (compressed, context)
+        x = context
 
-        x_ = self.final_layer(x + x_)
+        x_ = self._stage('final_layer', x + x_)
 
         outputs = []
 
-        x_ = F.interpolate(x_,
-                           size=[height_output_or, width_output_or],
-                           mode='bilinear', align_corners=True)
+        if self.output_labels and (self.inference_only or not self.augment):
+            x_ = upsample_argmax(x_, (height_output_or, width_output_or))
+        else:
+            x_ = F.interpolate(x_,
+                               size=[height_output_or, width_output_or],
+                               mode='bilinear', align_corners=True)
         outputs.append(x_)
 
-        if self.augment:
-            x_extra = self.seghead_extra(temp)
+        if self.augment and not self.inference_only:
+            x_extra = self._stage('seghead_extra', temp)
             return [x_, x_extra]
         else:
             return tuple(outputs)
 
 
-def DualResNet_imagenet(pretrained=False):
-    model = DualResNet(BasicBlock, [3, 4, 6, 3], num_classes=19,
-                       planes=64, spp_planes=128, head_planes=256, augment=False)
+def DualResNet_imagenet(pretrained=False, pretrained_path="./models/DDRNet39_imagenet.pth", **kwargs):
+    # pretrained weights overwrite the random init, so skip it
+    with skip_init(pretrained):
+        model = DualResNet(BasicBlock, [3, 4, 6, 3], num_classes=19,
+                           planes=64, spp_planes=128, head_planes=256, augment=False, **kwargs)
     if pretrained:
-
-        pretrained_state = torch.load(
-            "./models/DDRNet39_imagenet.pth", map_location='cpu')
-        model_dict = model.state_dict()
-        pretrained_state = {k: v for k, v in pretrained_state.items() if
-                            (k in model_dict and v.shape == model_dict[k].shape)}
-        model_dict.update(pretrained_state)
-
-        model.load_state_dict(model_dict, strict=False)
+        load_pretrained(model, pretrained_path)
         print("Having loaded imagenet-pretrained weights successfully!")
     return model
 
 
-def get_ddrnet_39(pretrained=False):
+def get_ddrnet_39(pretrained=False, **kwargs):
 
-    model = DualResNet_imagenet(pretrained=pretrained)
+    model = DualResNet_imagenet(pretrained=pretrained, **kwargs)
     return model
 
 
@@ -1,30 +1,55 @@
-from .DDRNet_23_slim import get_ddrnet_23_slim
-from .DDRNet_39 import get_ddrnet_39
-from .DDRNet_23 import get_ddrnet_23
-from .DDRNet_23_vis1 import get_ddrnet_23_vis1
-
-from .DDRNet_23 import get_CA_interact
-from .DDRNet_23 import get_CA_merge
+import importlib
 
+# variant name -> 'module:attribute'; modules are only imported on first use
 models = {
-    'ddrnet_39': get_ddrnet_39,
-    'ddrnet_23_slim': get_ddrnet_23_slim,
-    'ddrnet_23': get_ddrnet_23,
-    'ddrnet_23_vis1': get_ddrnet_23_vis1,
+    'ddrnet_39': '.DDRNet_39:get_ddrnet_39',
+    'ddrnet_23_slim': '.DDRNet_23_slim:get_ddrnet_23_slim',
+    'ddrnet_23': '.DDRNet_23:get_ddrnet_23',
+    'ddrnet_23_vis1': '.DDRNet_23_vis1:get_ddrnet_23_vis1',
+}
+
+intermodule={'inter': '.DDRNet_23:get_CA_interact'}
+
+mergemodule={'merge': '.DDRNet_23:get_CA_merge'}
+
+# names that used to be imported eagerly, kept importable from the package
+_lazy_attrs = {
+    'get_ddrnet_39': '.DDRNet_39:get_ddrnet_39',
+    'get_ddrnet_23_slim': '.DDRNet_23_slim:get_ddrnet_23_slim',
+    'get_ddrnet_23': '.DDRNet_23:get_ddrnet_23',
+    'get_ddrnet_23_vis1': '.DDRNet_23_vis1:get_ddrnet_23_vis1',
+    'get_CA_interact': '.DDRNet_23:get_CA_interact',
+    'get_CA_merge': '.DDRNet_23:get_CA_merge',
 }
 
-intermodule={'inter': get_CA_interact}
 
-mergemodule={'merge': get_CA_merge}
+def _resolve(target):
+    """Resolves an entry-point-like 'module:attribute' string, or returns a callable as is."""
+    if callable(target):
+        return target
+    module_name, _, attr = target.partition(':')
+    module = importlib.import_module(module_name, package=__name__)
+    return getattr(module, attr)
+
+
+def register_model(name, target, registry=models):
+    """Registers a variant as 'package.module:factory' (resolved lazily) or a callable."""
+    registry[name.lower()] = target
+
+
+def __getattr__(name):
+    if name in _lazy_attrs:
+        return _resolve(_lazy_attrs[name])
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 def get_segmentation_model(model, **kwargs):
     """Segmentation models"""
-    return models[model.lower()](**kwargs)
+    return _resolve(models[model.lower()])(**kwargs)
 
 def get_inter_model(model, **kwargs):
     """interaction C-A module"""
-    return intermodule[model.lower()](**kwargs)
+    return _resolve(intermodule[model.lower()])(**kwargs)
 
 def get_merge_model(model, **kwargs):
     """merge C-A models"""
-    return mergemodule[model.lower()](**kwargs)
+    return _resolve(mergemodule[model.lower()])(**kwargs)
@@ -0,0 +1,140 @@
+"""Checkpoint loading shared by the DDRNet variants."""
+import contextlib
+import logging
+import math
+import os
+import time
+from itertools import chain
+
+import torch
+import torch.nn as nn
+
+__all__ = ['load_checkpoint', 'remap_state_dict', 'load_pretrained', 'skip_init',
+           'build_from_checkpoint']
+
+logger = logging.getLogger('semantic_segmentation.checkpoint')
+
+
+def load_checkpoint(path, map_location='cpu', mmap=True):
+    """Loads a state dict from ``path``.
+
+    With ``mmap=True`` the tensors are backed by the memory-mapped file instead of
+    being read into private memory, so processes on one node loading the same
+    file share its page cache. Legacy (non-zipfile) checkpoints cannot be
+    memory-mapped and are read normally.
+    """
+    start = time.perf_counter()
+    try:
+        state = torch.load(path, map_location=map_location, mmap=mmap, weights_only=True)
+    except RuntimeError:
+        if not mmap:
+            raise
+        state = torch.load(path, map_location=map_location, weights_only=True)
+        mmap = False
+    if isinstance(state, dict) and isinstance(state.get('state_dict'), dict):
+        state = state['state_dict']
+    logger.info("Loaded {} ({:.1f} MiB, mmap={}) in {:.3f}s".format(
+        path, os.path.getsize(path) / 2 ** 20, mmap, time.perf_counter() - start))
+    return state
+
+
+def remap_state_dict(state, model_state, strip_prefixes=('module.',), rename=None):
+    """Matches checkpoint keys to model keys in one pass over each dict.
+
+    Keys are renamed by stripping ``strip_prefixes`` (e.g. the ``module.`` of
+    DistributedDataParallel checkpoints) and looking them up in the optional
+    ``rename`` table. Entries without a model key of the same shape are dropped.
+    """
+    remapped = {}
+    for key, value in state.items():
+        name = key
+        for prefix in strip_prefixes:
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        if rename is not None:
+            name = rename.get(name, name)
+        target = model_state.get(name)
+        if target is not None and target.shape == value.shape:
+            remapped[name] = value
+    return remapped
+
+
+@contextlib.contextmanager
+def skip_init(enabled=True):
+    """Builds modules on the meta device, so no random weights are materialized.
+
+    The weight initialization loops of the model constructors then run on
+    storage-less tensors; fill the model with :func:`load_pretrained` or use
+    :func:`build_from_checkpoint`.
+    """
+    if not enabled:
+        yield
+        return
+    with torch.device('meta'):
+        yield
+
+
+def _init_tensor(module, name, value):
+    # same rules as the constructors: kaiming conv weights, identity BatchNorm
+    if isinstance(module, nn.Conv2d) and name == 'weight':
+        nn.init.kaiming_normal_(value, mode='fan_out', nonlinearity='relu')
+    elif isinstance(module, nn.Conv2d) and name == 'bias':
+        fan_in = module.in_channels // module.groups * math.prod(module.kernel_size)
+        bound = 1 / math.sqrt(fan_in)
+        nn.init.uniform_(value, -bound, bound)
+    elif name in ('weight', 'running_var'):
+        nn.init.ones_(value)
+    else:
+        nn.init.zeros_(value)
+
+
+def _materialize_missing(model, device='cpu'):
+    """Allocates and initializes every tensor still on the meta device."""
+    num_initialized = 0
+    for module in model.modules():
+        for name, param in list(module.named_parameters(recurse=False)):
+            if param.is_meta:
+                value = torch.empty_like(param, device=device)
+                _init_tensor(module, name, value)
+                module._parameters[name] = nn.Parameter(value, requires_grad=param.requires_grad)
+                num_initialized += 1
+        for name, buf in list(module.named_buffers(recurse=False)):
+            if buf.is_meta:
+                value = torch.empty_like(buf, device=device)
+                _init_tensor(module, name, value)
+                module._buffers[name] = value
+                num_initialized += 1
+    return num_initialized
+
+
+def load_pretrained(model, path, **kwargs):
+    """Loads every matching tensor of the checkpoint at ``path`` into ``model``.
+
+    If ``model`` was built under :func:`skip_init`, the checkpoint tensors are
+    assigned instead of copied (keeping the memory-mapped pages shared) and only
+    the tensors the checkpoint does not provide are allocated and initialized.
+    Extra keyword arguments are passed to :func:`remap_state_dict`. Returns the
+    number of loaded tensors.
+    """
+    state = load_checkpoint(path)
+    remapped = remap_state_dict(state, model.state_dict(), **kwargs)
+    on_meta = any(t.is_meta for t in chain(model.parameters(), model.buffers()))
+    model.load_state_dict(remapped, strict=False, assign=on_meta)
+    if on_meta:
+        _materialize_missing(model)
+    logger.info("Matched {}/{} checkpoint tensors to {} model tensors".format(
+        len(remapped), len(state), len(model.state_dict())))
+    return len(remapped)
+
+
+def build_from_checkpoint(builder, path, map_location='cpu', **kwargs):
+    """Builds ``builder(**kwargs)`` without random init and fills it from ``path``.
+
+    The checkpoint must provide every parameter and buffer of the model. The
+    model tensors alias the (memory-mapped) checkpoint tensors.
+    """
+    with skip_init():
+        model = builder(**kwargs)
+    state = load_checkpoint(path, map_location=map_location)
+    model.load_state_dict(remap_state_dict(state, model.state_dict()), assign=True)
+    return model
@@ -0,0 +1,163 @@
+"""TorchScript and ONNX export of the DDRNet variants with dynamic input sizes."""
+import argparse
+import logging
+import os
+
+import torch
+import torch.nn as nn
+
+from .ops import traceable_copy
+
+__all__ = ['SegmentationExport', 'export_torchscript', 'export_onnx', 'load_onnx_session',
+           'check_export_parity']
+
+logger = logging.getLogger('semantic_segmentation.export')
+
+
+class SegmentationExport(nn.Module):
+    """Uniform export interface: N x 3 x H x W image -> N x nclass x H x W logits.
+
+    The variants return the logits nested in tuples or lists of different
+    shapes; the wrapper unwraps them so every exported artifact has exactly one
+    input and one output.
+    """
+
+    def __init__(self, model):
+        super(SegmentationExport, self).__init__()
+        self.model = traceable_copy(model)
+
+    def forward(self, image):
+        outputs = self.model(image)
+        while isinstance(outputs, (tuple, list)):
+            outputs = outputs[0]
+        return outputs
+
+
+def export_torchscript(model, path, example_input):
+    """Traces ``model`` and saves it to ``path``; returns the traced module.
+
+    The ``x.shape[-1] // 8`` style size arithmetic of the forward is recorded as
+    graph ops, so the artifact accepts any batch size and any H x W the eager
+    model accepts (multiples of the output stride 8, ``utils.inference.OUTPUT_STRIDE``).
+    """
+    wrapper = SegmentationExport(model).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, example_input, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, path)
+    logger.info("Saved TorchScript model to {} ({:.1f} MiB)".format(
+        path, os.path.getsize(path) / 2 ** 20))
+    return traced
+
+
+def export_onnx(model, path, example_input, opset_version=17):
+    """Exports ``model`` to ONNX at ``path`` with dynamic batch, height and width.
+
+    Requires the optional ``onnx`` package.
+    """
+    try:
+        import onnx  # noqa: F401
+    except ImportError:
+        raise ImportError("ONNX export requires the 'onnx' package: pip install onnx")
+    dynamic = {0: 'batch', 2: 'height', 3: 'width'}
+    with torch.no_grad():
+        torch.onnx.export(SegmentationExport(model).eval(), (example_input,), path,
+                          input_names=['image'], output_names=['logits'],
+                          dynamic_axes={'image': dynamic, 'logits': dynamic},
+                          opset_version=opset_version, dynamo=False)
+    logger.info("Saved ONNX model to {} ({:.1f} MiB)".format(
+        path, os.path.getsize(path) / 2 ** 20))
+    return path
+
+
+def load_onnx_session(path, num_threads=None):
+    """Returns a callable running the ONNX model at ``path`` with onnxruntime on the CPU.
+
+    Requires the optional ``onnxruntime`` package.
+    """
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("running ONNX models requires the 'onnxruntime' package: "
+                          "pip install onnxruntime")
+    options = onnxruntime.SessionOptions()
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def run(image):
+        logits, = session.run(None, {'image': image.cpu().numpy()})
+        return torch.from_numpy(logits)
+    return run
+
+
+def check_export_parity(model, exported, sizes, batch_size=1):
+    """Maximum relative output difference of ``exported`` against eager ``model``.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Eager reference model.
+    exported : callable
+        Exported artifact, e.g. a traced module or :func:`load_onnx_session`.
+    sizes : list of (H, W)
+        Input sizes to check; sizes other than the example size verify that the
+        artifact really has dynamic shapes.
+
+    Returns
+    -------
+    float
+        Largest ``max|a - b| / max|a|`` over all sizes.
+    """
+    reference = SegmentationExport(model).eval()
+    worst = 0.
+    with torch.no_grad():
+        for height, width in sizes:
+            image = torch.randn(batch_size, 3, height, width)
+            ref = reference(image)
+            out = exported(image)
+            if out.shape != ref.shape:
+                raise RuntimeError("exported output shape {} != eager {} at {}x{}".format(
+                    tuple(out.shape), tuple(ref.shape), height, width))
+            diff = ((ref - out).abs().max() / ref.abs().max().clamp(min=1e-12)).item()
+            worst = max(worst, diff)
+    return worst
+
+
+if __name__ == '__main__':
+    from models import get_segmentation_model
+    from utils.benchmark import measure_latency, format_table
+
+    parser = argparse.ArgumentParser(description='Export DDRNet variants, check parity and time them')
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['ddrnet_23', 'ddrnet_23_slim', 'ddrnet_39'])
+    parser.add_argument('--size', type=int, nargs=2, default=[512, 1024],
+                        help='example (and timing) input size')
+    parser.add_argument('--check-sizes', type=int, nargs='+', default=[256, 512, 384, 768],
+                        help='flattened H W pairs used for the parity check')
+    parser.add_argument('--formats', type=str, nargs='+', default=['torchscript', 'onnx'],
+                        choices=['torchscript', 'onnx'])
+    parser.add_argument('--output-dir', type=str, default='./exported_models')
+    parser.add_argument('--iters', type=int, default=5)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    image = torch.randn(1, 3, *args.size)
+    check_sizes = [tuple(args.size)] + list(zip(args.check_sizes[::2], args.check_sizes[1::2]))
+    rows = []
+    for name in args.models:
+        model = traceable_copy(get_segmentation_model(name, pretrained=False))
+        eager = measure_latency(SegmentationExport(model).eval(), image, iters=args.iters)
+        rows.append([name, 'eager', '', '{:.1f}'.format(eager * 1000), ''])
+        for fmt in args.formats:
+            if fmt == 'torchscript':
+                exported = export_torchscript(model, os.path.join(args.output_dir, name + '.pt'), image)
+            else:
+                path = export_onnx(model, os.path.join(args.output_dir, name + '.onnx'), image)
+                exported = load_onnx_session(path)
+            diff = check_export_parity(model, exported, check_sizes)
+            latency = measure_latency(exported, image, iters=args.iters)
+            rows.append([name, fmt, '{:.2e}'.format(diff), '{:.1f}'.format(latency * 1000),
+                         '{:.2f}x'.format(eager / latency)])
+    print(format_table(['model', 'runtime', 'rel. diff', 'ms', 'speedup'], rows))
@@ -0,0 +1,120 @@
+"""Inference-time folding of BatchNorm layers into the preceding convolutions."""
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_conv_bn_weights
+
+__all__ = ['fold_batchnorm', 'check_fold_parity']
+
+# conv -> bn attribute pairs of the blocks whose BNs are not inside an nn.Sequential.
+# segmenthead only folds bn2: bn1 is a pre-activation BN on C_ + A_.
+_BLOCK_PAIRS = {
+    'BasicBlock': (('conv1', 'bn1'), ('conv2', 'bn2')),
+    'Bottleneck': (('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')),
+    'segmenthead': (('conv1', 'bn2'),),
+    'segmentheadold': (('conv1', 'bn2'),),
+}
+
+
+def _fold_sequential(seq):
+    folded = 0
+    children = list(seq.named_children())
+    for (conv_name, conv), (bn_name, bn) in zip(children[:-1], children[1:]):
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, _BatchNorm):
+            setattr(seq, conv_name, fuse_conv_bn_eval(conv, bn))
+            setattr(seq, bn_name, nn.Identity())
+            folded += 1
+    return folded
+
+
+def _fold_dappm_process4(spp):
+    # process4 only feeds the last slice of the compression concat, so that
+    # slice of the compression BN goes into its conv and is reset to identity;
+    # the layer stays for the other four slices
+    conv, bn = spp.process4[-1], spp.compression[0]
+    if not isinstance(conv, nn.Conv2d) or not isinstance(bn, _BatchNorm):
+        return
+    channels = slice(bn.num_features - conv.out_channels, bn.num_features)
+    with torch.no_grad():
+        weight, bias = fuse_conv_bn_weights(
+            conv.weight, conv.bias, bn.running_mean[channels], bn.running_var[channels], bn.eps,
+            bn.weight[channels], bn.bias[channels])
+        conv.weight = weight
+        conv.bias = bias
+        bn.running_mean[channels] = 0.
+        bn.running_var[channels] = 1. - bn.eps
+        bn.weight[channels] = 1.
+        bn.bias[channels] = 0.
+
+
+def fold_batchnorm(model):
+    """Folds every conv -> BN pair of a DDRNet variant or C-A module in place.
+
+    Covers the ``conv1`` stem, ``BasicBlock``/``Bottleneck`` bodies and their
+    downsample paths, ``compression3/4``, ``down3/4``, ``segmenthead`` and the
+    ``CAinteract``/``CAmerge`` convs. The pre-activation BNs of ``DAPPM`` (and
+    ``segmenthead.bn1``) are kept. They are followed by a ReLU, so they cannot
+    go into the next conv, and most are fed by a sum or a zero-padded pooling of
+    tensors that other branches also consume. The one exception is the slice of
+    ``DAPPM.compression``'s BN over the ``process4`` output, which only that
+    conv produces: it is folded into the conv and set to identity, while the
+    layer keeps normalizing the other four slices of the concat.
+
+    The model is switched to eval mode, since folding uses the running statistics.
+    Returns the model and the number of folded BN layers.
+    """
+    model.eval()
+    folded = 0
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            folded += _fold_sequential(module)
+        if type(module).__name__ == 'DAPPM':
+            _fold_dappm_process4(module)
+        for conv_name, bn_name in _BLOCK_PAIRS.get(type(module).__name__, ()):
+            bn = getattr(module, bn_name)
+            if isinstance(bn, _BatchNorm):
+                setattr(module, conv_name, fuse_conv_bn_eval(getattr(module, conv_name), bn))
+                setattr(module, bn_name, nn.Identity())
+                folded += 1
+    return model, folded
+
+
+def check_fold_parity(model, folded_model, *inputs):
+    """Maximum absolute output difference, relative to the largest reference output."""
+    with torch.no_grad():
+        ref = model(*inputs)
+        out = folded_model(*inputs)
+    ref = [t for t in torch.utils._pytree.tree_flatten(ref)[0] if isinstance(t, torch.Tensor)]
+    out = [t for t in torch.utils._pytree.tree_flatten(out)[0] if isinstance(t, torch.Tensor)]
+    return max(((a - b).abs().max() / a.abs().max().clamp(min=1e-12)).item()
+               for a, b in zip(ref, out))
+
+
+if __name__ == '__main__':
+    from models import get_segmentation_model
+    from utils.benchmark import measure_latency, format_table
+
+    parser = argparse.ArgumentParser(description='BatchNorm folding parity and latency report')
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['ddrnet_23', 'ddrnet_23_slim', 'ddrnet_39'])
+    parser.add_argument('--size', type=int, nargs=2, default=[512, 1024])
+    parser.add_argument('--iters', type=int, default=5)
+    args = parser.parse_args()
+
+    image = torch.randn(1, 3, *args.size)
+    rows = []
+    for name in args.models:
+        model = get_segmentation_model(name, pretrained=False).eval()
+        bn_before = sum(isinstance(m, _BatchNorm) for m in model.modules())
+        folded, num_folded = fold_batchnorm(copy.deepcopy(model))
+        diff = check_fold_parity(model, folded, image)
+        eager = measure_latency(model, image, iters=args.iters)
+        fused = measure_latency(folded, image, iters=args.iters)
+        rows.append([name, bn_before, bn_before - num_folded, '{:.2e}'.format(diff),
+                     '{:.1f}'.format(eager * 1000), '{:.1f}'.format(fused * 1000),
+                     '{:.2f}x'.format(eager / fused)])
+    print(format_table(['model', 'BN before', 'BN after', 'rel. diff',
+                        'eager ms', 'folded ms', 'speedup'], rows))
@@ -0,0 +1,304 @@
+"""Functional building blocks shared by the DDRNet variants."""
+import contextlib
+import copy
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+__all__ = ['upsample_argmax', 'box_pool_pyramid', 'cached_context', 'branch_executor', 'submit_branch',
+           'set_parallel_branches', 'traceable_copy', 'checkpoint_stage', 'resolve_checkpoint_stages', 'keep_batchnorm_fp32',
+           'keep_logits_fp32']
+
+
+def upsample_argmax(logits, size, band_rows=128):
+    """Label map of ``F.interpolate(logits, size, mode='bilinear', align_corners=True)``.
+
+    The full-resolution N x C x H x W scores are never materialized: the
+    interpolation is split into a horizontal pass at the input height and a
+    vertical pass done in bands of ``band_rows`` output rows, each reduced with
+    argmax right away. This is the same weight order the bilinear kernel uses,
+    so the labels match the dense path.
+
+    Returns
+    -------
+    Tensor
+        N x H x W int64 labels.
+    """
+    height, width = size
+    in_height = logits.shape[-2]
+    # rows stay put with align_corners=True, so this only interpolates columns
+    logits = F.interpolate(logits, size=[in_height, width], mode='bilinear', align_corners=True)
+
+    scale = float(in_height - 1) / (height - 1) if height > 1 else 0.
+    labels = logits.new_empty((logits.shape[0], height, width), dtype=torch.long)
+    for start in range(0, height, band_rows):
+        stop = min(start + band_rows, height)
+        src = torch.arange(start, stop, dtype=torch.float32, device=logits.device) * scale
+        lo = src.floor().long().clamp(max=in_height - 1)
+        hi = (lo + 1).clamp(max=in_height - 1)
+        weight = (src - lo.float()).to(logits.dtype).view(1, 1, -1, 1)
+        band = logits.index_select(2, lo) * (1 - weight) + logits.index_select(2, hi) * weight
+        labels[:, start:stop] = band.argmax(1)
+    return labels
+
+
+def _as_pair(value):
+    return tuple(value) if isinstance(value, (tuple, list)) else (value, value)
+
+
+def box_pool_pyramid(x, pools):
+    """Applies several average pooling modules to ``x`` from one summed-area table.
+
+    ``pools`` may hold ``nn.AvgPool2d`` modules (with ``count_include_pad=True``
+    and ``ceil_mode=False``, the defaults) and ``nn.AdaptiveAvgPool2d((1, 1))``.
+    Zero padding adds nothing to a box sum and every box is divided by the full
+    kernel area, which reproduces the padding semantics of ``avg_pool2d``. The
+    table is accumulated in float64 to keep the large-kernel differences exact
+    to float32 precision.
+
+    DAPPM does not use it: the table is slower than separate ``AvgPool2d``
+    passes at every frame size measured, see the ``integral_pooling`` report of
+    ``utils/benchmark.py``.
+
+    Returns
+    -------
+    list of Tensor
+        One pooled tensor per entry of ``pools``, in the dtype of ``x``.
+    """
+    specs = []
+    for pool in pools:
+        if isinstance(pool, nn.AvgPool2d):
+            if not pool.count_include_pad or pool.ceil_mode or pool.divisor_override:
+                raise ValueError("Unsupported AvgPool2d configuration: {}".format(pool))
+            specs.append((_as_pair(pool.kernel_size),
+                          _as_pair(pool.stride or pool.kernel_size),
+                          _as_pair(pool.padding)))
+        elif isinstance(pool, nn.AdaptiveAvgPool2d) and _as_pair(pool.output_size) == (1, 1):
+            specs.append(None)
+        else:
+            raise ValueError("Unsupported pooling module: {}".format(pool))
+
+    height, width = x.shape[-2:]
+    pad_h = max([s[2][0] for s in specs if s is not None] + [0])
+    pad_w = max([s[2][1] for s in specs if s is not None] + [0])
+    # one extra leading zero row/column, so table[i, j] is the sum of padded[:i, :j]
+    table = F.pad(x.double(), (pad_w + 1, pad_w, pad_h + 1, pad_h))
+    table = table.cumsum(-2).cumsum(-1)
+
+    def corners(row, col, num_rows, num_cols, stride):
+        # strided view of the table entries at the given window corners
+        return table[..., row:row + (num_rows - 1) * stride[0] + 1:stride[0],
+                     col:col + (num_cols - 1) * stride[1] + 1:stride[1]]
+
+    outputs = []
+    for spec in specs:
+        if spec is None:
+            (k_h, k_w), stride = (height, width), (1, 1)
+            row, col, out_h, out_w = pad_h, pad_w, 1, 1
+        else:
+            (k_h, k_w), stride, (p_h, p_w) = spec
+            out_h = (height + 2 * p_h - k_h) // stride[0] + 1
+            out_w = (width + 2 * p_w - k_w) // stride[1] + 1
+            row, col = pad_h - p_h, pad_w - p_w
+        out = (corners(row + k_h, col + k_w, out_h, out_w, stride)
+               - corners(row, col + k_w, out_h, out_w, stride)
+               - corners(row + k_h, col, out_h, out_w, stride)
+               + corners(row, col, out_h, out_w, stride))
+        outputs.append((out / (k_h * k_w)).to(x.dtype))
+    return outputs
+
+
+def cached_context(model, batch_size, height, width):
+    """The ``context_cache`` of ``model`` if it can be reused for the current input.
+
+    Returns None unless ``reuse_context`` is on and the cache was computed for
+    ``batch_size`` inputs whose 1/8-resolution features are ``height x width``,
+    so a stale cache is recomputed rather than broadcast over another batch.
+    """
+    cache = model.context_cache if model.reuse_context else None
+    if cache is None:
+        return None
+    compressed = cache[0]
+    if compressed.shape[0] != batch_size or tuple(compressed.shape[-2:]) != (height, width):
+        return None
+    return cache
+
+
+_branch_executor = None
+# marks the threads of the branch pool, see submit_branch
+_branch_thread = threading.local()
+
+
+def branch_executor():
+    """Shared thread pool that runs independent branches of a forward pass."""
+    global _branch_executor
+    if _branch_executor is None:
+        _branch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='ddrnet-branch')
+    return _branch_executor
+
+
+def submit_branch(fn, *args):
+    """Runs ``fn(*args)`` on the branch pool under the caller's grad/inference/autocast mode.
+
+    Calls made from a branch that already runs on the pool (e.g. the ``DAPPM``
+    scales inside the context branch) run inline and return a finished future:
+    a worker blocking on work queued behind it would deadlock the pool once
+    several forwards run at the same time.
+    """
+    if getattr(_branch_thread, 'active', False):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as exc:
+            future.set_exception(exc)
+        return future
+
+    # grad, inference and autocast modes are thread-local, so carry them over to the worker
+    grad_enabled = torch.is_grad_enabled()
+    inference = torch.is_inference_mode_enabled()
+    autocast = [(device, torch.get_autocast_dtype(device)) for device in ('cpu', 'cuda')
+                if torch.is_autocast_enabled(device)]
+
+    def run():
+        _branch_thread.active = True
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(torch.inference_mode(inference))
+            stack.enter_context(torch.set_grad_enabled(grad_enabled))
+            for device, dtype in autocast:
+                stack.enter_context(torch.autocast(device, dtype=dtype))
+            return fn(*args)
+
+    return branch_executor().submit(run)
+
+
+def set_parallel_branches(model, enabled=True):
+    """Toggles concurrent branch execution on every submodule that supports it.
+
+    The low-resolution context path then runs alongside the high-resolution
+    ``layer5_`` and the four ``DAPPM`` pooling scales run alongside each other,
+    using inter-op parallelism on otherwise idle cores. Outputs are unchanged.
+    Lower ``torch.set_num_threads`` if intra-op threads oversubscribe the CPU.
+    """
+    for module in model.modules():
+        if hasattr(module, 'parallel_branches'):
+            module.parallel_branches = enabled
+    return model
+
+
+def _batchnorm_input_fp32(module, args):
+    return tuple(arg.float() for arg in args)
+
+
+def _batchnorm_output_autocast(module, args, output):
+    # hand the next layer the reduced-precision dtype it would have received
+    device = output.device.type
+    if torch.is_autocast_enabled(device):
+        return output.to(torch.get_autocast_dtype(device))
+    return output
+
+
+def keep_batchnorm_fp32(model):
+    """Makes every BatchNorm layer of ``model`` normalize in fp32 under autocast.
+
+    Pre-hooks cast the reduced-precision input to fp32, so the statistics and
+    the affine transform are applied in full precision; the output is cast back
+    to the autocast dtype. Returns the hook handles; ``handle.remove()`` undoes it.
+    """
+    handles = []
+    for module in model.modules():
+        if isinstance(module, _BatchNorm):
+            handles.append(module.register_forward_pre_hook(_batchnorm_input_fp32))
+            handles.append(module.register_forward_hook(_batchnorm_output_autocast))
+    return handles
+
+
+def _logits_fp32(module, args, output):
+    # segmenthead returns the logits, or (logits, C_update, Cupdate) in DDRNet_23
+    if isinstance(output, tuple):
+        return (output[0].float(),) + output[1:]
+    return output.float()
+
+
+def keep_logits_fp32(model, heads=('final_layer', 'seghead_extra')):
+    """Casts the logits of the segmentation heads of ``model`` to fp32.
+
+    Under autocast the full-resolution upsampling, and the banded argmax of
+    ``output_labels``, then run in fp32 rather than on reduced-precision
+    logits. Returns the hook handles; ``handle.remove()`` undoes it.
+    """
+    return [module.register_forward_hook(_logits_fp32)
+            for name, module in model.named_modules() if name.split('.')[-1] in heads]
+
+
+# python-level control flow that graph capture (FX, tracing, export) would
+# either freeze to the example shapes or fail on
+_UNTRACEABLE_MODES = ('parallel_branches', 'output_labels', 'reuse_context')
+
+
+def traceable_copy(model):
+    """Eval-mode copy of ``model`` that only returns the segmentation output.
+
+    The threaded branches, the context cache and the banded argmax are
+    switched off, so the forward is a plain tensor program that can be traced
+    for any input size.
+    """
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        for attr in _UNTRACEABLE_MODES:
+            if getattr(module, attr, False):
+                setattr(module, attr, False)
+    # the auxiliary C/A outputs only feed the training losses
+    if hasattr(model, 'inference_only'):
+        model.inference_only = True
+    return model
+
+
+@contextlib.contextmanager
+def _keep_batchnorm_stats(module):
+    # the recomputation must not update the running statistics a second time
+    buffers = [(bn, {name: buf.clone() for name, buf in bn.named_buffers(recurse=False)})
+               for bn in module.modules() if isinstance(bn, _BatchNorm) and bn.training]
+    try:
+        yield
+    finally:
+        for bn, saved in buffers:
+            for name, value in saved.items():
+                getattr(bn, name).copy_(value)
+
+
+def checkpoint_stage(module, *args, enabled=True, fn=None, **kwargs):
+    """Runs ``module(*args, **kwargs)``, or ``fn(*args, **kwargs)`` if given.
+
+    With ``enabled=True`` and autograd recording, the activations inside the
+    stage are not stored for backward but recomputed from its inputs
+    (non-reentrant ``torch.utils.checkpoint``). The BatchNorm layers of
+    ``module`` keep the running statistics of the original forward.
+    """
+    if fn is None:
+        fn = module
+    if not enabled or not torch.is_grad_enabled():
+        return fn(*args, **kwargs)
+    return checkpoint(fn, *args, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), _keep_batchnorm_stats(module)),
+                      **kwargs)
+
+
+def resolve_checkpoint_stages(model, stages):
+    """Validated set of stage names to checkpoint; ``True`` selects every stage.
+
+    The stages of a model are listed in its ``checkpointable_stages`` attribute.
+    """
+    available = tuple(name for name in model.checkpointable_stages if hasattr(model, name))
+    if stages is True:
+        return frozenset(available)
+    stages = frozenset(stages or ())
+    unknown = stages.difference(available)
+    if unknown:
+        raise ValueError("unknown checkpoint stages {} of {}, expected a subset of {}".format(
+            sorted(unknown), type(model).__name__, list(available)))
+    return stages
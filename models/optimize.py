@@ -0,0 +1,73 @@
+"""Channels-last and compiled inference for the DDRNet variants."""
+import os
+
+import torch
+import torch.nn as nn
+
+from .ops import traceable_copy
+
+__all__ = ['ChannelsLastInference', 'set_compile_cache', 'optimize_for_inference']
+
+
+class ChannelsLastInference(nn.Module):
+    """Runs a segmentation model on channels-last (NHWC) inputs.
+
+    The convolutions of ``BasicBlock``, ``DAPPM`` and ``segmenthead`` then skip
+    the per-layer layout conversions of the NCHW path. Returns the main
+    N x nclass x H x W output.
+    """
+
+    def __init__(self, model, channels_last=True):
+        super(ChannelsLastInference, self).__init__()
+        self.model = traceable_copy(model)
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.model.to(memory_format=self.memory_format)
+
+    def forward(self, image):
+        outputs = self.model(image.contiguous(memory_format=self.memory_format))
+        while isinstance(outputs, (tuple, list)):
+            outputs = outputs[0]
+        return outputs
+
+
+def set_compile_cache(cache_dir):
+    """Keeps the compiled graphs and kernels in ``cache_dir`` across processes.
+
+    Warm starts then load the generated code instead of recompiling. Must be
+    called before the first compiled call.
+    """
+    import torch._inductor.config as inductor_config
+
+    cache_dir = os.path.abspath(cache_dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    inductor_config.fx_graph_cache = True
+    return cache_dir
+
+
+def optimize_for_inference(model, channels_last=True, use_compile=True, cache_dir=None,
+                           mode=None, dynamic=None):
+    """Returns an eval-mode inference copy of ``model``, optionally channels-last and compiled.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Any registered segmentation model; it is copied, not modified.
+    channels_last : bool
+        Convert weights and inputs to the channels-last memory format.
+    use_compile : bool
+        Compile the forward with ``torch.compile`` (inductor). The first call per
+        input shape compiles, which takes a while without a warm cache.
+    cache_dir : str, optional
+        Persistent compile cache, see :func:`set_compile_cache`.
+    mode, dynamic
+        Passed to ``torch.compile``; ``dynamic=None`` recompiles with dynamic
+        shapes once a second input size is seen.
+    """
+    wrapper = ChannelsLastInference(model, channels_last=channels_last).eval()
+    if not use_compile:
+        return wrapper
+    if cache_dir is not None:
+        set_compile_cache(cache_dir)
+    return torch.compile(wrapper, mode=mode, dynamic=dynamic)
@@ -0,0 +1,138 @@
+"""Post-training INT8 quantization of the DDRNet variants for CPU inference."""
+import argparse
+import logging
+import time
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from .checkpoint import load_checkpoint
+from .ops import traceable_copy
+
+__all__ = ['prepare_int8', 'calibrate', 'convert_int8', 'quantize_int8',
+           'build_int8_from_checkpoint', 'int8_cost_report']
+
+logger = logging.getLogger('semantic_segmentation.quantize')
+
+def prepare_int8(model, example_input, backend='x86'):
+    """Returns an observed copy of ``model`` ready for calibration.
+
+    The model is traced with FX, which fuses every conv -> BN (-> ReLU) chain,
+    including the downsample paths, and inserts observers on the residual
+    ``out += residual`` adds, the branch sums and the bilinear ``F.interpolate``
+    calls of the bilateral paths, so they run on quantized tensors as well.
+
+    Parameters
+    ----------
+    model : nn.Module
+        fp32 DualResNet; it is copied, not modified.
+    example_input : Tensor
+        N x 3 x H x W image batch used for tracing.
+    backend : str
+        Quantized engine, 'x86'/'fbgemm' for servers or 'qnnpack' for ARM.
+    """
+    torch.backends.quantized.engine = backend
+    return prepare_fx(traceable_copy(model), get_default_qconfig_mapping(backend),
+                      (example_input,))
+
+
+def calibrate(prepared, loader, num_batches=50, device='cpu'):
+    """Runs the first ``num_batches`` batches of ``loader`` through the observers."""
+    num_images = 0
+    with torch.no_grad():
+        for i, batch in enumerate(loader):
+            if num_batches is not None and i >= num_batches:
+                break
+            prepared(batch[0].to(device))
+            num_images += batch[0].shape[0]
+    logger.info("Calibrated INT8 observers on {} images".format(num_images))
+    return prepared
+
+
+def convert_int8(prepared):
+    """Replaces the observed modules with their quantized kernels."""
+    return convert_fx(prepared)
+
+
+def quantize_int8(model, loader, num_batches=50, backend='x86'):
+    """Fuses, calibrates on ``loader`` and converts ``model`` to INT8 on the CPU."""
+    model = traceable_copy(model).cpu()
+    example_input = next(iter(loader))[0][:1]
+    prepared = prepare_int8(model, example_input, backend=backend)
+    return convert_int8(calibrate(prepared, loader, num_batches=num_batches))
+
+
+def build_int8_from_checkpoint(builder, path, backend='x86', **kwargs):
+    """Builds ``builder(**kwargs)`` and loads an INT8 state dict saved from :func:`quantize_int8`.
+
+    The quantized graph is re-created with uncalibrated observers, whose scales
+    and zero points are then overwritten by the checkpoint.
+    """
+    model = builder(**kwargs)
+    prepared = prepare_int8(model, torch.zeros(1, 3, 64, 64), backend=backend)
+    quantized = convert_fx(prepared)
+    quantized.load_state_dict(load_checkpoint(path, mmap=False))
+    return quantized
+
+
+def int8_cost_report(model, quantized, loader, nclass, max_batches=None):
+    """Measures CPU latency and accuracy of the fp32 and INT8 models on ``loader``.
+
+    Returns the report as a text table, including the mIoU delta and speedup.
+    """
+    from utils.benchmark import format_table
+    from utils.collate import unpad
+    from utils.inference import get_seg_logits
+    from utils.score import SegmentationMetric
+
+    model = traceable_copy(model).cpu()
+    results = []
+    for net in (model, quantized):
+        metric = SegmentationMetric(nclass)
+        elapsed = 0.
+        for i, batch in enumerate(loader):
+            if max_batches is not None and i >= max_batches:
+                break
+            image, target, sizes = batch[0], batch[1], batch[3]
+            start = time.perf_counter()
+            with torch.no_grad():
+                scores = get_seg_logits(net(image))
+            elapsed += time.perf_counter() - start
+            metric.update(unpad(scores, sizes), unpad(target, sizes))
+        pixAcc, mIoU = metric.get()
+        results.append((elapsed, pixAcc, mIoU))
+    (fp32_time, fp32_acc, fp32_miou), (int8_time, int8_acc, int8_miou) = results
+    rows = [['fp32', '{:.1f}'.format(fp32_time * 1000), '{:.3f}'.format(fp32_acc * 100),
+             '{:.3f}'.format(fp32_miou * 100), '', ''],
+            ['int8', '{:.1f}'.format(int8_time * 1000), '{:.3f}'.format(int8_acc * 100),
+             '{:.3f}'.format(int8_miou * 100), '{:+.3f}'.format((int8_miou - fp32_miou) * 100),
+             '{:.2f}x'.format(fp32_time / max(int8_time, 1e-12))]]
+    return format_table(['model', 'total ms', 'pixAcc', 'mIoU', 'mIoU delta', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    from models import get_segmentation_model
+    from utils.benchmark import measure_latency, format_table
+
+    parser = argparse.ArgumentParser(description='INT8 quantization latency report on random inputs')
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['ddrnet_23', 'ddrnet_23_slim', 'ddrnet_39'])
+    parser.add_argument('--size', type=int, nargs=2, default=[512, 1024])
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--backend', type=str, default='x86')
+    args = parser.parse_args()
+
+    image = torch.randn(1, 3, *args.size)
+    rows = []
+    for name in args.models:
+        model = traceable_copy(get_segmentation_model(name, pretrained=False))
+        prepared = prepare_int8(model, image, backend=args.backend)
+        with torch.no_grad():
+            prepared(image)
+        quantized = convert_int8(prepared)
+        fp32 = measure_latency(model, image, iters=args.iters)
+        int8 = measure_latency(quantized, image, iters=args.iters)
+        rows.append([name, '{:.1f}'.format(fp32 * 1000), '{:.1f}'.format(int8 * 1000),
+                     '{:.2f}x'.format(fp32 / int8)])
+    print(format_table(['model', 'fp32 ms', 'int8 ms', 'speedup'], rows))
@@ -0,0 +1,183 @@
+"""Scores saved prediction PNGs against the ground truth without running a model.
+
+Predictions written by ``eval.py`` (``runs/pred_pic/...``) are paired with the
+Cityscapes ground truth by file name, e.g. ``aachen_000000_000019_leftImg8bit.png``
+with ``gtFine/val/aachen/aachen_000000_000019_gtFine_labelIds.png``. The images
+are decoded and scored on a process pool; every task accumulates its own
+``hist_info`` confusion matrix and the merged matrix is reported through
+``compute_score``. As in ``SegmentationMetric``, mIoU averages over all classes,
+counting a class absent from both the labels and the predictions as 0 (the
+``nanmean`` of ``compute_score`` would skip it). Several prediction directories
+(e.g. of different checkpoints) can be compared in one run.
+
+    python offline_eval.py --gt-dir D:/alldaycityscapes/gtFine/val \\
+        --pred-dirs runs/pred_pic/ddrnet_23_resnet50_citys
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from utils.benchmark import format_table
+from utils.score import hist_info, compute_score
+
+__all__ = ['labelid_to_trainid', 'pair_predictions', 'score_pairs']
+
+# Cityscapes labelId -> trainId; all other labelIds are ignored (-1)
+_CITYSCAPES_TRAIN_IDS = {7: 0, 8: 1, 11: 2, 12: 3, 13: 4, 17: 5, 19: 6, 20: 7, 21: 8, 22: 9,
+                         23: 10, 24: 11, 25: 12, 26: 13, 27: 14, 28: 15, 31: 16, 32: 17, 33: 18}
+
+CITYSCAPES_CLASSES = ('road', 'sidewalk', 'building', 'wall', 'fence', 'pole', 'traffic light',
+                      'traffic sign', 'vegetation', 'terrain', 'sky', 'person', 'rider', 'car',
+                      'truck', 'bus', 'train', 'motorcycle', 'bicycle')
+
+
+def _build_lookup():
+    lookup = np.full(256, -1, dtype=np.int64)
+    for label_id, train_id in _CITYSCAPES_TRAIN_IDS.items():
+        lookup[label_id] = train_id
+    return lookup
+
+
+_LOOKUP = _build_lookup()
+
+
+def labelid_to_trainid(label):
+    """Maps a Cityscapes ``*_labelIds.png`` array to train ids, -1 for ignored pixels."""
+    return _LOOKUP[label]
+
+
+def _sample_key(filename, suffix):
+    name = os.path.basename(filename)
+    return name[:-len(suffix)] if name.endswith(suffix) else None
+
+
+def _index_dir(root, suffix):
+    index = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            key = _sample_key(filename, suffix)
+            if key is not None:
+                index[key] = os.path.join(dirpath, filename)
+    return index
+
+
+def pair_predictions(pred_dir, gt_dir, pred_suffix='_leftImg8bit.png',
+                     gt_suffix='_gtFine_labelIds.png'):
+    """Pairs the predictions in ``pred_dir`` with the ground truth in ``gt_dir`` by file name.
+
+    Both directories are searched recursively; a file's sample name is its name
+    without the suffix. Returns the sorted ``(prediction, ground truth)`` path
+    pairs and the number of unmatched predictions and ground truth files.
+    """
+    preds = _index_dir(pred_dir, pred_suffix)
+    gts = _index_dir(gt_dir, gt_suffix)
+    keys = sorted(set(preds) & set(gts))
+    return [(preds[k], gts[k]) for k in keys], len(preds) - len(keys), len(gts) - len(keys)
+
+
+def _score_chunk(pairs, nclass, label_ids, pred_offset):
+    hist = np.zeros((nclass, nclass), dtype=np.int64)
+    labeled = correct = 0
+    for pred_path, gt_path in pairs:
+        # palette PNGs decode to their indices, i.e. the predicted train ids
+        pred = np.array(Image.open(pred_path), dtype=np.int64) + pred_offset
+        label = np.array(Image.open(gt_path), dtype=np.int64)
+        if label_ids:
+            label = labelid_to_trainid(label)
+        if pred.shape != label.shape:
+            raise ValueError("{} is {}, but its ground truth {} is {}".format(
+                pred_path, pred.shape, gt_path, label.shape))
+        h, l, c = hist_info(pred, label, nclass)
+        hist += h
+        labeled += l
+        correct += c
+    return hist, labeled, correct
+
+
+def score_pairs(pairs, nclass=19, label_ids=True, pred_offset=0, num_workers=None, chunk_size=16):
+    """Scores ``(prediction, ground truth)`` PNG pairs on a process pool.
+
+    Parameters
+    ----------
+    pairs : list of (str, str)
+        Paths, e.g. from :func:`pair_predictions`.
+    label_ids : bool
+        The ground truth holds Cityscapes labelIds, which are mapped to train
+        ids; otherwise it already holds train ids (255 is ignored).
+    pred_offset : int
+        Added to the decoded predictions, e.g. -1 for ade20k masks.
+    num_workers : int, optional
+        Number of worker processes; defaults to the number of CPUs.
+
+    Returns
+    -------
+    hist, labeled, correct
+        Merged confusion matrix and pixel counts, as taken by ``compute_score``.
+    """
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    hist = np.zeros((nclass, nclass), dtype=np.int64)
+    labeled = correct = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(_score_chunk, chunks, [nclass] * len(chunks),
+                               [label_ids] * len(chunks), [pred_offset] * len(chunks))
+        for h, l, c in results:
+            hist += h
+            labeled += l
+            correct += c
+    return hist, labeled, correct
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Score saved prediction PNGs against the ground truth')
+    parser.add_argument('--pred-dirs', type=str, nargs='+', required=True,
+                        help='prediction directories, e.g. one per checkpoint')
+    parser.add_argument('--gt-dir', type=str, required=True,
+                        help='ground truth directory, e.g. .../gtFine/val')
+    parser.add_argument('--pred-suffix', type=str, default='_leftImg8bit.png')
+    parser.add_argument('--gt-suffix', type=str, default='_gtFine_labelIds.png',
+                        help='"_gtFine_labelTrainIds.png" for ground truth already in train ids')
+    parser.add_argument('--nclass', type=int, default=19)
+    parser.add_argument('--dataset', type=str, default='citys',
+                        help='dataset the masks were colorized for; ade20k masks are shifted by one')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of scoring processes, defaults to the number of CPUs')
+    parser.add_argument('--per-class', action='store_true', default=False,
+                        help='also print the per-class IoU of every directory')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    label_ids = args.gt_suffix.endswith('labelIds.png')
+    pred_offset = -1 if args.dataset == 'ade20k' else 0
+    rows, ious = [], []
+    for pred_dir in args.pred_dirs:
+        pairs, unmatched_preds, unmatched_gts = pair_predictions(
+            pred_dir, args.gt_dir, args.pred_suffix, args.gt_suffix)
+        if not pairs:
+            sys.exit("no prediction in {} matches the ground truth in {}".format(pred_dir, args.gt_dir))
+        if unmatched_preds or unmatched_gts:
+            print("{}: {} predictions without ground truth, {} ground truth files without "
+                  "prediction".format(pred_dir, unmatched_preds, unmatched_gts))
+        hist, labeled, correct = score_pairs(pairs, nclass=args.nclass, label_ids=label_ids,
+                                             pred_offset=pred_offset, num_workers=args.workers)
+        with np.errstate(invalid='ignore'):
+            iu, _, _, mean_pixel_acc = compute_score(hist, correct, labeled)
+        # absent classes have a NaN IoU; average them as 0 like SegmentationMetric
+        mean_IU = np.nan_to_num(iu).mean()
+        rows.append([pred_dir, len(pairs), '{:.3f}'.format(mean_pixel_acc * 100),
+                     '{:.3f}'.format(mean_IU * 100)])
+        ious.append(iu)
+    if args.per_class:
+        names = CITYSCAPES_CLASSES if args.nclass == len(CITYSCAPES_CLASSES) else range(args.nclass)
+        print(format_table(['class'] + ['#{}'.format(i) for i in range(len(args.pred_dirs))],
+                           [[name] + ['-' if np.isnan(iu[c]) else '{:.2f}'.format(iu[c] * 100)
+                                      for iu in ious]
+                            for c, name in enumerate(names)]))
+        print()
+    print(format_table(['#', 'predictions', 'images', 'pixAcc', 'mIoU'],
+                       [[i] + row for i, row in enumerate(rows)]))
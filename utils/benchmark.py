@@ -0,0 +1,417 @@
+"""Latency and memory measurement helpers used by the benchmark reports."""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import weakref
+
+import torch
+import torch.nn.functional as F
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from torch.utils.flop_counter import FlopCounterMode
+
+__all__ = ['measure_latency', 'measure_peak_memory', 'count_flops', 'measure_import_time',
+           'format_table']
+
+
+def _sync(device):
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure_latency(fn, *args, warmup=2, iters=10, device=None, grad=False):
+    """Mean wall-clock seconds of ``fn(*args)`` after ``warmup`` untimed calls."""
+    with torch.set_grad_enabled(grad):
+        for _ in range(warmup):
+            fn(*args)
+        _sync(device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn(*args)
+        _sync(device)
+    return (time.perf_counter() - start) / iters
+
+
+class _TensorMemoryTracker(TorchDispatchMode):
+    """Tracks the bytes of tensor storages allocated while the mode is active."""
+
+    def __init__(self):
+        super(_TensorMemoryTracker, self).__init__()
+        self.live = 0
+        self.peak = 0
+        self._storages = set()
+
+    def _release(self, key, nbytes):
+        self.live -= nbytes
+        self._storages.discard(key)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_flatten(out)[0]:
+            if not isinstance(t, torch.Tensor):
+                continue
+            storage = t.untyped_storage()
+            key = storage.data_ptr()
+            if key in self._storages or storage.nbytes() == 0:
+                continue
+            self._storages.add(key)
+            self.live += storage.nbytes()
+            self.peak = max(self.peak, self.live)
+            weakref.finalize(storage, self._release, key, storage.nbytes())
+        return out
+
+
+def measure_peak_memory(fn, *args, device=None, grad=False):
+    """Peak bytes of tensor memory allocated by ``fn(*args)`` on top of its inputs."""
+    with torch.set_grad_enabled(grad):
+        if device is not None and torch.device(device).type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+            fn(*args)
+            torch.cuda.synchronize(device)
+            return torch.cuda.max_memory_allocated(device) - base
+        tracker = _TensorMemoryTracker()
+        with tracker:
+            fn(*args)
+        return tracker.peak
+
+
+def count_flops(fn, *args):
+    """Total FLOPs of ``fn(*args)`` as counted by ``FlopCounterMode``."""
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        fn(*args)
+    return counter.get_total_flops()
+
+
+def measure_import_time(stmt, setup='', repeat=5):
+    """Best-of-``repeat`` seconds to run ``stmt`` in a fresh interpreter after ``setup``."""
+    code = ('import time\n{}\nstart = time.perf_counter()\n{}\n'
+            'print(time.perf_counter() - start)').format(setup, stmt)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        times.append(float(out.decode().strip().splitlines()[-1]))
+    return min(times)
+
+
+def format_table(header, rows):
+    """Formats rows of values as a fixed-width text table."""
+    rows = [[str(v) for v in row] for row in rows]
+    widths = [max(len(str(h)), *(len(row[i]) for row in rows)) if rows else len(str(h))
+              for i, h in enumerate(header)]
+    lines = ['  '.join(str(h).ljust(w) for h, w in zip(header, widths)),
+             '  '.join('-' * w for w in widths)]
+    lines += ['  '.join(v.ljust(w) for v, w in zip(row, widths)) for row in rows]
+    return '\n'.join(line.rstrip() for line in lines)
+
+
+def inference_only_report(model_names, size, iters=5):
+    """Compares the default forward with ``inference_only`` for each variant."""
+    from models import get_segmentation_model
+
+    image = torch.randn(1, 3, *size)
+    rows = []
+    for name in model_names:
+        model = get_segmentation_model(name, pretrained=False).eval()
+        stats = []
+        for inference_only in (False, True):
+            model.inference_only = inference_only
+            stats.append((count_flops(model, image), measure_peak_memory(model, image),
+                          measure_latency(model, image, iters=iters)))
+        (flops, mem, lat), (flops_inf, mem_inf, lat_inf) = stats
+        rows.append([name,
+                     '{:.2f}'.format(flops / 1e9), '{:.2f}'.format(flops_inf / 1e9),
+                     '{:.1f}'.format(mem / 2 ** 20), '{:.1f}'.format(mem_inf / 2 ** 20),
+                     '{:.1f}'.format(lat * 1000), '{:.1f}'.format(lat_inf * 1000)])
+    return format_table(['model', 'GFLOPs', 'GFLOPs (inf)', 'peak MiB', 'peak MiB (inf)',
+                         'ms', 'ms (inf)'], rows)
+
+
+def output_labels_report(model_names, size, iters=5):
+    """Label parity, peak memory and latency of ``output_labels`` against the dense upsample + argmax."""
+    from models import get_segmentation_model
+    from utils.inference import get_seg_logits
+
+    image = torch.randn(1, 3, *size)
+    rows = []
+    for name in model_names:
+        model = get_segmentation_model(name, pretrained=False).eval()
+        model.inference_only = True
+
+        def dense(x):
+            return get_seg_logits(model(x)).argmax(1)
+
+        with torch.no_grad():
+            reference = dense(image)
+            model.output_labels = True
+            mismatches = (get_seg_logits(model(image)) != reference).sum().item()
+            model.output_labels = False
+        stats = []
+        for output_labels in (False, True):
+            model.output_labels = output_labels
+            stats.append((measure_peak_memory(dense if not output_labels else model, image),
+                          measure_latency(dense if not output_labels else model, image, iters=iters)))
+        (mem, lat), (mem_labels, lat_labels) = stats
+        rows.append([name, mismatches, '{:.1f}'.format(mem / 2 ** 20),
+                     '{:.1f}'.format(mem_labels / 2 ** 20), '{:.1f}'.format(lat * 1000),
+                     '{:.1f}'.format(lat_labels * 1000)])
+    return format_table(['model', 'label mismatches', 'peak MiB', 'peak MiB (labels)', 'ms',
+                         'ms (labels)'], rows)
+
+
+def parallel_branches_report(model_names, size, iters=5):
+    """Latency of sequential against concurrent branch execution for each variant."""
+    from models import get_segmentation_model
+    from models.ops import set_parallel_branches
+
+    image = torch.randn(1, 3, *size)
+    rows = []
+    for name in model_names:
+        model = get_segmentation_model(name, pretrained=False).eval()
+        model.inference_only = True
+        sequential = measure_latency(model, image, iters=iters)
+        set_parallel_branches(model)
+        concurrent = measure_latency(model, image, iters=iters)
+        rows.append([name, '{:.1f}'.format(sequential * 1000), '{:.1f}'.format(concurrent * 1000),
+                     '{:.2f}x'.format(sequential / concurrent)])
+    return format_table(['model', 'sequential ms', 'concurrent ms', 'speedup'], rows)
+
+
+def compile_report(model_names, size, batch_size=1, iters=5, cache_dir='./runs/compile_cache'):
+    """Throughput of eager NCHW, eager channels-last and compiled channels-last inference.
+
+    The first compiled call includes compilation; run the report twice to see
+    the warm-start time with a populated ``cache_dir``.
+    """
+    from models import get_segmentation_model
+    from models.optimize import optimize_for_inference
+
+    image = torch.randn(batch_size, 3, *size)
+    rows = []
+    for name in model_names:
+        model = get_segmentation_model(name, pretrained=False)
+        eager = optimize_for_inference(model, channels_last=False, use_compile=False)
+        nhwc = optimize_for_inference(model, channels_last=True, use_compile=False)
+        compiled = optimize_for_inference(model, channels_last=True, cache_dir=cache_dir)
+        start = time.perf_counter()
+        with torch.no_grad():
+            compiled(image)
+        first_call = time.perf_counter() - start
+        timings = [measure_latency(fn, image, iters=iters) for fn in (eager, nhwc, compiled)]
+        rows.append([name] + ['{:.2f}'.format(batch_size / t) for t in timings] +
+                    ['{:.1f}'.format(first_call), '{:.2f}x'.format(timings[0] / timings[2])])
+    return format_table(['model', 'eager img/s', 'channels-last img/s', 'compiled img/s',
+                         'first call s', 'speedup'], rows)
+
+
+def _train_step(model, image):
+    outputs = [t for t in tree_flatten(model(image))[0] if isinstance(t, torch.Tensor)]
+    sum(t.float().square().mean() for t in outputs).backward()
+    for param in model.parameters():
+        param.grad = None
+
+
+def checkpointing_report(model_names, size, batch_size=2, iters=5, device=None):
+    """Peak memory and training step time without and with activation checkpointing."""
+    from models import get_segmentation_model
+
+    image = torch.randn(batch_size, 3, *size, device=device)
+    rows = []
+    for name in model_names:
+        results = []
+        for stages in ((), True):
+            model = get_segmentation_model(name, pretrained=False,
+                                           checkpoint_stages=stages).to(device).train()
+            peak = measure_peak_memory(_train_step, model, image, device=device, grad=True)
+            step = measure_latency(_train_step, model, image, warmup=1, iters=iters,
+                                   device=device, grad=True)
+            results.append((peak, step))
+        (peak, step), (peak_ckpt, step_ckpt) = results
+        rows.append([name, '{:.0f}'.format(peak / 2 ** 20), '{:.0f}'.format(peak_ckpt / 2 ** 20),
+                     '{:.1f}'.format(100. * (1 - peak_ckpt / peak)), '{:.1f}'.format(step * 1000),
+                     '{:.1f}'.format(step_ckpt * 1000), '{:.2f}x'.format(step_ckpt / step)])
+    return format_table(['model', 'peak MiB', 'peak MiB (ckpt)', 'saved %', 'step ms',
+                         'step ms (ckpt)', 'slowdown'], rows)
+
+
+def tiling_report(model_name, size, tile_sizes, overlap=None, iters=3):
+    """Peak memory, latency and full-frame parity of sliding-window inference per tile size."""
+    from models import get_segmentation_model
+    from utils.inference import get_seg_logits, sliding_window_inference, check_tiling_parity
+
+    model = get_segmentation_model(model_name, pretrained=False).eval()
+    model.inference_only = True
+    image = torch.randn(1, 3, *size)
+    nclass = model.final_layer.conv2.out_channels
+
+    def full_frame(x):
+        return get_seg_logits(model(x))
+
+    rows = [['full frame', '{:.0f}'.format(measure_peak_memory(full_frame, image) / 2 ** 20),
+             '{:.1f}'.format(measure_latency(full_frame, image, iters=iters) * 1000), '', '']]
+    for tile in tile_sizes:
+        diff, agreement = check_tiling_parity(model, image, nclass, tile, overlap=overlap)
+        rows.append(['{}x{}'.format(*tile),
+                     '{:.0f}'.format(measure_peak_memory(sliding_window_inference, model, image, nclass,
+                                                         tile, overlap) / 2 ** 20),
+                     '{:.1f}'.format(measure_latency(sliding_window_inference, model, image, nclass,
+                                                     tile, overlap, iters=iters) * 1000),
+                     '{:.1e}'.format(diff), '{:.2f}'.format(agreement * 100)])
+    return format_table(['tile', 'peak MiB', 'ms', 'rel. diff', 'label agreement %'], rows)
+
+
+def integral_pooling_report(frame_sizes, iters=5):
+    """DAPPM pooling cost of separate AvgPool2d passes against one summed-area table.
+
+    DAPPM runs at 1/64 of the frame resolution on the 1024-channel DDRNet_23
+    features. DAPPM itself always uses the separate passes; its time with the
+    table is estimated by swapping the pooling times. The fp32 column only
+    builds a float32 table, without the corner lookups.
+    """
+    import torch.nn.functional as F
+    from models.DDRNet_23 import DAPPM
+    from models.ops import box_pool_pyramid
+
+    spp = DAPPM(1024, 128, 256).eval()
+    pools = [spp.scale1[0], spp.scale2[0], spp.scale3[0], spp.scale4[0]]
+
+    pad = max(pool.padding for pool in pools[:3])
+
+    def build_fp32_table(t):
+        return F.pad(t, (pad + 1, pad, pad + 1, pad)).cumsum(-2).cumsum(-1)
+
+    rows = []
+    for height, width in frame_sizes:
+        x = torch.randn(1, 1024, height // 64, width // 64)
+        separate = measure_latency(lambda t: [pool(t) for pool in pools], x, iters=iters)
+        table = measure_latency(box_pool_pyramid, x, pools, iters=iters)
+        table_fp32 = measure_latency(build_fp32_table, x, iters=iters)
+        diff = max((pool(x) - out).abs().max().item()
+                   for pool, out in zip(pools, box_pool_pyramid(x, pools)))
+        module = measure_latency(spp, x, iters=iters)
+        rows.append(['{}x{}'.format(height, width), '{}x{}'.format(*x.shape[-2:]),
+                     '{:.3f}'.format(separate * 1000), '{:.3f}'.format(table * 1000),
+                     '{:.3f}'.format(table_fp32 * 1000), '{:.1e}'.format(diff),
+                     '{:.3f}'.format(module * 1000),
+                     '{:.3f}'.format((module - separate + table) * 1000)])
+    return format_table(['frame', 'DAPPM input', 'pools ms', 'table ms', 'fp32 table build ms',
+                         'max |diff|', 'DAPPM ms', 'DAPPM ms (table, est.)'], rows)
+
+
+def _load_frames(frames_dir, size):
+    import numpy as np
+    from PIL import Image
+
+    mean = torch.tensor([.485, .456, .406]).view(1, 3, 1, 1)
+    std = torch.tensor([.229, .224, .225]).view(1, 3, 1, 1)
+    frames = []
+    for name in sorted(os.listdir(frames_dir)):
+        image = Image.open(os.path.join(frames_dir, name)).convert('RGB')
+        image = image.resize((size[1], size[0]), Image.BILINEAR)
+        image = torch.from_numpy(np.asarray(image, dtype=np.float32) / 255.)
+        frames.append((image.permute(2, 0, 1).unsqueeze(0) - mean) / std)
+    return frames
+
+
+def _synthetic_frames(size, num_frames, step=4):
+    # a smooth random scene panned by ``step`` pixels per frame, with a cut halfway
+    height, width = size
+    frames = []
+    for scene in range(2):
+        coarse = torch.randn(1, 3, height // 128, (width + num_frames * step) // 128)
+        canvas = F.interpolate(coarse, size=(height, width + num_frames * step),
+                               mode='bicubic', align_corners=False)
+        for i in range(num_frames // 2):
+            frames.append(canvas[..., i * step:i * step + width].contiguous())
+    return frames
+
+
+def streaming_report(model_name, size, num_frames=32, frames_dir=None):
+    """Latency and accuracy of streaming context reuse against per-frame inference.
+
+    Uses the sorted images in ``frames_dir`` as the video if given, otherwise a
+    synthetic panning sequence with one scene cut.
+    """
+    from models import get_segmentation_model
+    from utils.inference import streaming_cost_report
+
+    model = get_segmentation_model(model_name, pretrained=False).eval()
+    model.inference_only = True
+    if frames_dir is not None:
+        frames = _load_frames(frames_dir, size)
+    else:
+        frames = _synthetic_frames(size, num_frames)
+    settings = [(1, None), (2, None), (4, None), (8, None), (30, 0.2), (30, 0.5)]
+    return streaming_cost_report(model, frames, settings)
+
+
+def import_time_report(model_name, repeat=5):
+    """Start-up cost of the lazy model registry against importing every variant."""
+    eager = ('import models.DDRNet_39, models.DDRNet_23_slim, models.DDRNet_23, '
+             'models.DDRNet_23_vis1')
+    lazy = 'from models import get_segmentation_model'
+    build = '; get_segmentation_model({!r}, pretrained=False)'.format(model_name)
+    rows = []
+    # torch dominates a cold start, so also report the cost on top of a warm torch import
+    for setup in ('', 'import torch'):
+        label = 'after torch' if setup else 'cold'
+        rows.append(['eager registry ({})'.format(label),
+                     '{:.1f}'.format(1000 * measure_import_time(eager, setup, repeat))])
+        rows.append(['lazy registry ({})'.format(label),
+                     '{:.1f}'.format(1000 * measure_import_time(lazy, setup, repeat))])
+        rows.append(['lazy + build {} ({})'.format(model_name, label),
+                     '{:.1f}'.format(1000 * measure_import_time(lazy + build, setup, repeat))])
+    return format_table(['import', 'ms'], rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Model benchmark reports')
+    parser.add_argument('report', choices=['inference_only', 'output_labels', 'import_time',
+                                           'parallel_branches', 'integral_pooling',
+                                           'streaming', 'checkpointing',
+                                           'compile', 'tiling'])
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['ddrnet_23', 'ddrnet_23_slim', 'ddrnet_39'])
+    parser.add_argument('--size', type=int, nargs=2, default=[1024, 2048])
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--frames', type=str, default=None,
+                        help='directory of consecutive video frames for the streaming report')
+    parser.add_argument('--batch-size', type=int, default=2,
+                        help='training batch size of the checkpointing report')
+    parser.add_argument('--compile-cache', type=str, default='./runs/compile_cache',
+                        help='persistent compile cache of the compile report')
+    parser.add_argument('--num-frames', type=int, default=32,
+                        help='length of the synthetic video of the streaming report')
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=[512, 1024, 1024, 1024],
+                        help='flattened tile H W pairs of the tiling report')
+    parser.add_argument('--tile-overlap', type=int, default=None,
+                        help='tile overlap of the tiling report, defaults to a quarter of the tile size')
+    args = parser.parse_args()
+
+    if args.report == 'inference_only':
+        print(inference_only_report(args.models, args.size, args.iters))
+    elif args.report == 'output_labels':
+        print(output_labels_report(args.models, args.size, args.iters))
+    elif args.report == 'parallel_branches':
+        print(parallel_branches_report(args.models, args.size, args.iters))
+    elif args.report == 'integral_pooling':
+        print(integral_pooling_report([(512, 1024), (1024, 2048), (2048, 4096), (4096, 8192)],
+                                      args.iters))
+    elif args.report == 'streaming':
+        print(streaming_report(args.models[0], args.size, num_frames=args.num_frames,
+                               frames_dir=args.frames))
+    elif args.report == 'checkpointing':
+        device = 'cuda' if torch.cuda.is_available() else None
+        print(checkpointing_report(args.models, args.size, args.batch_size, args.iters, device))
+    elif args.report == 'tiling':
+        print(tiling_report(args.models[0], args.size,
+                            list(zip(args.tile_sizes[::2], args.tile_sizes[1::2])),
+                            args.tile_overlap, args.iters))
+    elif args.report == 'compile':
+        print(compile_report(args.models, args.size, args.batch_size, args.iters, args.compile_cache))
+    elif args.report == 'import_time':
+        print(import_time_report(args.models[0], args.iters))
@@ -0,0 +1,73 @@
+"""Batch collation helpers for evaluating images of unequal size."""
+import torch
+from PIL import Image
+from torch.utils.data import Subset
+
+__all__ = ['pad_collate', 'unpad', 'image_sizes']
+
+
+def pad_collate(batch, image_fill=0, target_fill=-1):
+    """Stacks ``(image, target, filename)`` samples into one padded batch.
+
+    Images and targets are padded at the bottom/right to the largest height and
+    width in the batch. Padded target pixels are set to ``target_fill`` so they
+    are ignored by the metrics even before cropping. The model does see the
+    padding, though: convolutions at the image border and the global pooling of
+    ``DAPPM`` make the logits of a padded sample differ from its batch-1 logits.
+    Batch equal-size samples only (``GroupedBatchSampler`` with
+    :func:`image_sizes`) to keep the batch-1 results.
+
+    Returns
+    -------
+    images : Tensor, N x C x H x W
+    targets : Tensor, N x H x W
+    filenames : list of str
+    sizes : list of (height, width) tuples of the unpadded samples
+    """
+    images, targets, filenames = zip(*batch)
+    sizes = [tuple(img.shape[-2:]) for img in images]
+    height = max(h for h, _ in sizes)
+    width = max(w for _, w in sizes)
+
+    if all(size == (height, width) for size in sizes):
+        return torch.stack(images, 0), torch.stack(targets, 0), list(filenames), sizes
+
+    image_batch = images[0].new_full((len(images), images[0].shape[0], height, width), image_fill)
+    target_batch = targets[0].new_full((len(targets), height, width), target_fill)
+    for i, ((h, w), img, target) in enumerate(zip(sizes, images, targets)):
+        image_batch[i, :, :h, :w].copy_(img)
+        target_batch[i, :h, :w].copy_(target)
+    return image_batch, target_batch, list(filenames), sizes
+
+
+def unpad(tensor, sizes):
+    """Crops the padding of a batched tensor away.
+
+    Returns ``tensor`` unchanged when no sample was padded, otherwise a list of
+    per-sample views of shape 1 x ... x h x w, which ``SegmentationMetric.update``
+    accepts directly.
+    """
+    height, width = tensor.shape[-2:]
+    if all(size == (height, width) for size in sizes):
+        return tensor
+    return [tensor[i:i + 1, ..., :h, :w] for i, (h, w) in enumerate(sizes)]
+
+
+def image_sizes(dataset):
+    """(height, width) of every sample, read from the headers of its image files.
+
+    Assumes samples keep the size of their files, as in the 'testval' mode.
+    Returns None if the dataset does not list one image path per sample in an
+    ``images`` attribute.
+    """
+    if isinstance(dataset, Subset):
+        sizes = image_sizes(dataset.dataset)
+        return None if sizes is None else [sizes[i] for i in dataset.indices]
+    paths = getattr(dataset, 'images', None)
+    if paths is None or len(paths) != len(dataset):
+        return None
+    sizes = []
+    for path in paths:
+        with Image.open(path) as image:
+            sizes.append((image.height, image.width))
+    return sizes
@@ -11,8 +11,8 @@ import torch.distributed as dist
 from torch.utils.data.sampler import Sampler, BatchSampler
 
 __all__ = ['get_world_size', 'get_rank', 'synchronize', 'is_main_process',
-           'all_gather', 'make_data_sampler', 'make_batch_data_sampler',
-           'reduce_dict', 'reduce_loss_dict']
+           'all_gather', 'all_reduce_sum', 'make_data_sampler', 'make_batch_data_sampler',
+           'GroupedBatchSampler', 'SkipSampler', 'reduce_dict', 'reduce_loss_dict']
 
 
 # reference: https://github.com/facebookresearch/maskrcnn-benchmark/blob/master/maskrcnn_benchmark/utils/comm.py
@@ -94,6 +94,17 @@ def all_gather(data):
     return data_list
 
 
+def all_reduce_sum(tensor):
+    """
+    Sums a tensor in place across all processes with a single collective,
+    so every rank ends up with the global value. Returns the tensor.
+    """
+    if get_world_size() < 2:
+        return tensor
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
@@ -148,9 +159,9 @@ def reduce_loss_dict(loss_dict):
     return reduced_losses
 
 
-def make_data_sampler(dataset, shuffle, distributed):
+def make_data_sampler(dataset, shuffle, distributed, pad=True):
     if distributed:
-        return DistributedSampler(dataset, shuffle=shuffle)
+        return DistributedSampler(dataset, shuffle=shuffle, pad=pad)
     if shuffle:
         sampler = data.sampler.RandomSampler(dataset)
     else:
@@ -158,8 +169,8 @@ def make_data_sampler(dataset, shuffle, distributed):
     return sampler
 
 
-def make_batch_data_sampler(sampler, images_per_batch, num_iters=None, start_iter=0):
-    batch_sampler = data.sampler.BatchSampler(sampler, images_per_batch, drop_last=True)
+def make_batch_data_sampler(sampler, images_per_batch, num_iters=None, start_iter=0, drop_last=True):
+    batch_sampler = data.sampler.BatchSampler(sampler, images_per_batch, drop_last=drop_last)
     if num_iters is not None:
         batch_sampler = IterationBasedBatchSampler(batch_sampler, num_iters, start_iter)
     return batch_sampler
@@ -179,9 +190,12 @@ class DistributedSampler(Sampler):
         num_replicas (optional): Number of processes participating in
             distributed training.
         rank (optional): Rank of the current process within num_replicas.
+        pad (optional): Repeat samples so every rank gets the same number of
+            them. Disable for evaluation, where repeated samples would be
+            counted twice; ranks then differ by at most one sample.
     """
 
-    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True):
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, pad=True):
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
@@ -194,8 +208,13 @@ class DistributedSampler(Sampler):
         self.num_replicas = num_replicas
         self.rank = rank
         self.epoch = 0
-        self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / self.num_replicas))
-        self.total_size = self.num_samples * self.num_replicas
+        self.pad = pad
+        if pad:
+            self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / self.num_replicas))
+            self.total_size = self.num_samples * self.num_replicas
+        else:
+            self.num_samples = len(range(self.rank, len(self.dataset), self.num_replicas))
+            self.total_size = len(self.dataset)
         self.shuffle = shuffle
 
     def __iter__(self):
@@ -207,6 +226,12 @@ class DistributedSampler(Sampler):
         else:
             indices = torch.arange(len(self.dataset)).tolist()
 
+        if not self.pad:
+            # disjoint strided shards that together cover the dataset exactly once
+            indices = indices[self.rank:self.total_size:self.num_replicas]
+            assert len(indices) == self.num_samples
+            return iter(indices)
+
         # add extra samples to make it evenly divisible
         indices += indices[: (self.total_size - len(indices))]
         assert len(indices) == self.total_size
@@ -225,6 +250,63 @@ class DistributedSampler(Sampler):
         self.epoch = epoch
 
 
+class GroupedBatchSampler(BatchSampler):
+    """Batches the indices of ``sampler`` so that each batch holds one group only.
+
+    Used to batch only samples of equal size, e.g. with ``group_ids`` set to the
+    image sizes. A group's batch is emitted once it is full; the incomplete
+    batches follow at the end unless ``drop_last`` is set. The order is
+    deterministic for a deterministic sampler.
+    """
+
+    def __init__(self, sampler, group_ids, batch_size, drop_last=False):
+        self.sampler = sampler
+        self.group_ids = group_ids
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        pending = {}
+        for index in self.sampler:
+            batch = pending.setdefault(self.group_ids[index], [])
+            batch.append(index)
+            if len(batch) == self.batch_size:
+                yield batch
+                del pending[self.group_ids[index]]
+        if not self.drop_last:
+            for batch in pending.values():
+                yield batch
+
+    def __len__(self):
+        counts = {}
+        for index in self.sampler:
+            counts[self.group_ids[index]] = counts.get(self.group_ids[index], 0) + 1
+        if self.drop_last:
+            return sum(count // self.batch_size for count in counts.values())
+        return sum(-(-count // self.batch_size) for count in counts.values())
+
+
+class SkipSampler(Sampler):
+    """Wraps a sampler and leaves out the indices in ``skip``.
+
+    ``skip`` is read when iteration starts, so it can be filled in after the
+    data loader is built, e.g. with the samples a resumed evaluation has
+    already scored. The wrapped sampler must be deterministic.
+    """
+
+    def __init__(self, sampler, skip):
+        self.sampler = sampler
+        self.skip = skip
+
+    def __iter__(self):
+        skip = set(self.skip)
+        return iter([index for index in self.sampler if index not in skip])
+
+    def __len__(self):
+        skip = set(self.skip)
+        return sum(1 for index in self.sampler if index not in skip)
+
+
 class IterationBasedBatchSampler(BatchSampler):
     """
     Wraps a BatchSampler, resampling from it until
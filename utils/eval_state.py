@@ -0,0 +1,88 @@
+"""Checkpointed evaluation progress, so a preempted evaluation can resume."""
+import logging
+import os
+
+import torch
+
+__all__ = ['EvalCheckpoint']
+
+logger = logging.getLogger('semantic_segmentation.eval_state')
+
+
+class EvalCheckpoint(object):
+    """Saves the metric state and the indices of the scored samples every ``every`` samples.
+
+    The metrics accumulate integer confusion matrices, which do not depend on
+    the order of the samples, so a resumed run that skips the saved indices
+    (see :class:`utils.distributed.SkipSampler`) ends with exactly the result of
+    an uninterrupted run.
+
+    Parameters
+    ----------
+    path : str
+        Checkpoint file. It is replaced atomically, so a run killed while
+        saving leaves the previous checkpoint intact.
+    every : int
+        Number of scored samples between two saves.
+    meta : dict, optional
+        Settings the checkpoint must have been made with (model, weights,
+        dataset size, ...); resuming with different ones raises an error.
+    """
+
+    def __init__(self, path, every=50, meta=None):
+        self.path = path
+        self.every = every
+        self.meta = dict(meta or {})
+        # kept as the same object, so samplers holding it see the restored indices
+        self.done = set()
+        self._unsaved = 0
+
+    def restore(self, metrics):
+        """Loads the saved state into ``metrics`` (a dict of name -> metric).
+
+        Returns the number of samples already scored; 0 without a checkpoint.
+        """
+        self.done.clear()
+        self._unsaved = 0
+        if not os.path.exists(self.path):
+            return 0
+        state = torch.load(self.path, map_location='cpu')
+        if state['meta'] != self.meta:
+            raise ValueError("evaluation checkpoint {} was made with {}, not {}; delete it to "
+                             "start over".format(self.path, state['meta'], self.meta))
+        for name, metric in metrics.items():
+            metric.load_state_dict(state['metrics'][name])
+        self.done.update(state['done'])
+        logger.info("Resuming evaluation from {} with {} scored samples".format(
+            self.path, len(self.done)))
+        return len(self.done)
+
+    def step(self, indices, metrics, flush=None):
+        """Marks ``indices`` as scored and saves once ``every`` samples are unsaved.
+
+        ``flush`` is called before saving, e.g. to wait for the queued prediction
+        writes, so no sample is checkpointed before its outputs are on disk.
+        """
+        self.done.update(indices)
+        self._unsaved += len(indices)
+        if self._unsaved >= self.every:
+            if flush is not None:
+                flush()
+            self.save(metrics)
+
+    def save(self, metrics):
+        state = {
+            'meta': self.meta,
+            'metrics': {name: metric.state_dict() for name, metric in metrics.items()},
+            'done': sorted(self.done),
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
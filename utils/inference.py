@@ -0,0 +1,439 @@
+"""Inference helpers shared by evaluation and deployment scripts."""
+import time
+
+import torch
+import torch.nn.functional as F
+
+from .benchmark import format_table
+from .collate import unpad
+from .distributed import all_reduce_sum
+from .score import SegmentationMetric
+
+__all__ = ['get_seg_logits', 'sliding_window_inference', 'check_tiling_parity', 'MultiScaleFlipInference',
+           'tta_cost_report', 'StreamingInference', 'streaming_cost_report', 'AutocastInference',
+           'amp_accuracy_guard']
+
+
+def get_seg_logits(outputs):
+    """Returns the main N x C x H x W segmentation output of a model call."""
+    # DDRNet_23 returns (tuple(outputs), C_, C), the other variants tuple(outputs)
+    while isinstance(outputs, (list, tuple)):
+        outputs = outputs[0]
+    return outputs
+
+
+# input sizes must be divisible by the output stride of the models, otherwise
+# the high- and low-resolution branches do not line up
+OUTPUT_STRIDE = 8
+
+
+def _tile_starts(length, tile, stride):
+    starts = list(range(0, max(length - tile, 0) + 1, stride))
+    if starts[-1] + tile < length:
+        starts.append(length - tile)
+    return starts
+
+
+def _blend_window(height, width, blend, device):
+    if blend == 'mean':
+        return torch.ones(1, 1, height, width, device=device)
+    if blend == 'gaussian':
+        ys = torch.arange(height, dtype=torch.float32, device=device) - (height - 1) / 2.
+        xs = torch.arange(width, dtype=torch.float32, device=device) - (width - 1) / 2.
+        wy = torch.exp(-0.5 * (ys / (height / 4.)) ** 2)
+        wx = torch.exp(-0.5 * (xs / (width / 4.)) ** 2)
+        return (wy[:, None] * wx[None, :]).clamp(min=1e-3)[None, None]
+    raise ValueError("Unknown blend mode: {}".format(blend))
+
+
+def sliding_window_inference(model, image, nclass, tile_size, overlap=None, blend='mean', probs=False):
+    """Runs ``model`` on overlapping tiles and blends the results.
+
+    Peak activation memory is bounded by ``tile_size`` rather than by the frame;
+    only the N x nclass x H x W accumulator scales with the input.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Any registered segmentation model.
+    image : Tensor
+        N x 3 x H x W input batch.
+    nclass : int
+        Number of output classes.
+    tile_size : int or (int, int)
+        Tile height and width, rounded up to a multiple of ``OUTPUT_STRIDE``.
+        Tiles are clipped to the largest such multiple that fits in the frame.
+    overlap : int, optional
+        Overlap between neighbouring tiles in pixels, at least 0 and less than
+        the tile size; defaults to a quarter of the tile size.
+    blend : str
+        'mean' averages overlapping tiles uniformly, 'gaussian' down-weights tile borders.
+    probs : bool
+        Accumulate softmax probabilities instead of raw logits.
+
+    Returns
+    -------
+    Tensor
+        N x nclass x H x W blended scores.
+    """
+    if isinstance(tile_size, int):
+        tile_size = (tile_size, tile_size)
+    height, width = image.shape[-2:]
+    if height < OUTPUT_STRIDE or width < OUTPUT_STRIDE:
+        raise ValueError("frame of {}x{} is smaller than the output stride {}".format(
+            height, width, OUTPUT_STRIDE))
+    tile_h, tile_w = [min(-(-tile // OUTPUT_STRIDE) * OUTPUT_STRIDE, length - length % OUTPUT_STRIDE)
+                      for tile, length in zip(tile_size, (height, width))]
+    strides = []
+    for tile, length in zip((tile_h, tile_w), (height, width)):
+        tile_overlap = tile // 4 if overlap is None else overlap
+        if tile >= length:
+            # a tile covering the whole axis is placed once, whatever the overlap
+            strides.append(tile)
+        elif 0 <= tile_overlap < tile:
+            strides.append(tile - tile_overlap)
+        else:
+            raise ValueError("tile overlap must be in [0, {}) for tiles of {}, got {}".format(
+                tile, tile, tile_overlap))
+    stride_h, stride_w = strides
+
+    window = _blend_window(tile_h, tile_w, blend, image.device)
+    scores = image.new_zeros((image.shape[0], nclass, height, width))
+    weights = image.new_zeros((1, 1, height, width))
+    for y in _tile_starts(height, tile_h, stride_h):
+        for x in _tile_starts(width, tile_w, stride_w):
+            out = get_seg_logits(model(image[..., y:y + tile_h, x:x + tile_w]))
+            if probs:
+                out = F.softmax(out, dim=1)
+            if blend != 'mean':
+                out = out.mul_(window)
+            scores[..., y:y + tile_h, x:x + tile_w] += out
+            weights[..., y:y + tile_h, x:x + tile_w] += window
+    return scores.div_(weights)
+
+
+def check_tiling_parity(model, image, nclass, tile_size, overlap=None, blend='mean'):
+    """Compares :func:`sliding_window_inference` with one full-frame forward of ``model``.
+
+    Tiles see less context than the full frame, so the scores differ unless
+    one tile covers the whole frame, in which case they match exactly.
+
+    Returns
+    -------
+    (float, float)
+        Largest ``max|a - b| / max|a|`` of the logits and the fraction of
+        pixels whose label agrees with the full-frame label.
+    """
+    with torch.no_grad():
+        full = get_seg_logits(model(image))
+        tiled = sliding_window_inference(model, image, nclass, tile_size, overlap=overlap,
+                                         blend=blend)
+    diff = ((full - tiled).abs().max() / full.abs().max().clamp(min=1e-12)).item()
+    agreement = (full.argmax(1) == tiled.argmax(1)).double().mean().item()
+    return diff, agreement
+
+
+class MultiScaleFlipInference(object):
+    """Batched multi-scale and horizontal-flip test-time augmentation.
+
+    Each scale costs one forward pass: the batch is resized once, to the
+    nearest multiple of ``OUTPUT_STRIDE`` of the scaled size, and, with
+    ``flip=True``, concatenated with its mirror along the batch dimension.
+    Scores of every pass are resized to a shared working resolution and summed
+    into a single running accumulator, so no per-scale full-resolution result is
+    kept around.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Any registered segmentation model.
+    scales : sequence of float
+        Input scale factors.
+    flip : bool
+        Also run the horizontally flipped batch.
+    fuse_scale : float
+        Working resolution of the accumulator relative to the input size. The
+        fused scores are upsampled to the input size at the end.
+    probs : bool
+        Fuse softmax probabilities instead of raw logits.
+    """
+
+    def __init__(self, model, scales=(1.0,), flip=True, fuse_scale=1.0, probs=True):
+        self.model = model
+        self.scales = tuple(scales)
+        self.flip = flip
+        self.fuse_scale = fuse_scale
+        self.probs = probs
+
+    def __call__(self, image):
+        batch, _, height, width = image.shape
+        work_size = (int(height * self.fuse_scale + 0.5), int(width * self.fuse_scale + 0.5))
+
+        fused = None
+        for scale in self.scales:
+            size = tuple(max(int(length * scale / OUTPUT_STRIDE + 0.5), 1) * OUTPUT_STRIDE
+                         for length in (height, width))
+            x = image
+            if size != (height, width):
+                x = F.interpolate(image, size=size, mode='bilinear', align_corners=True)
+            if self.flip:
+                x = torch.cat([x, x.flip(-1)], 0)
+
+            out = get_seg_logits(self.model(x))
+            if self.probs:
+                out = F.softmax(out, dim=1)
+            if tuple(out.shape[-2:]) != work_size:
+                out = F.interpolate(out, size=work_size, mode='bilinear', align_corners=True)
+            if self.flip:
+                out = out[:batch] + out[batch:].flip(-1)
+
+            fused = out if fused is None else fused.add_(out)
+
+        if work_size != (height, width):
+            fused = F.interpolate(fused, size=(height, width), mode='bilinear', align_corners=True)
+        return fused
+
+
+def tta_cost_report(model, loader, scale_sets, nclass, flip=True, device='cpu', max_batches=None):
+    """Measures latency and accuracy of several TTA scale sets on ``loader``.
+
+    Returns the report as a text table with one row per scale set.
+    """
+    rows = []
+    for scales in scale_sets:
+        engine = MultiScaleFlipInference(model, scales=scales, flip=flip)
+        metric = SegmentationMetric(nclass)
+        elapsed, num_images = 0., 0
+        for i, batch in enumerate(loader):
+            if max_batches is not None and i >= max_batches:
+                break
+            image, target = batch[0].to(device), batch[1].to(device)
+            start = time.perf_counter()
+            with torch.no_grad():
+                scores = engine(image)
+            if image.is_cuda:
+                torch.cuda.synchronize(image.device)
+            elapsed += time.perf_counter() - start
+            num_images += image.shape[0]
+            metric.update(scores, target)
+        pixAcc, mIoU = metric.get()
+        rows.append([','.join('{:g}'.format(s) for s in scales), flip,
+                     '{:.1f}'.format(1000. * elapsed / max(num_images, 1)),
+                     '{:.3f}'.format(pixAcc * 100), '{:.3f}'.format(mIoU * 100)])
+    return format_table(['scales', 'flip', 'ms/img', 'pixAcc', 'mIoU'], rows)
+
+
+class StreamingInference(object):
+    """Frame-by-frame video inference that reuses the low-resolution context.
+
+    Consecutive frames of a video are nearly identical, so the expensive
+    ``layer4 -> layer5 -> DAPPM`` context path and its ``compression4`` term are
+    computed on a key frame, cached in the model and reused for the following
+    frames; the high-resolution appearance branch runs on every frame. The
+    context is refreshed every ``refresh_interval`` frames, or earlier when the
+    scene change since the key frame exceeds ``scene_threshold``. The model
+    keeps a cached context only while the engine is open; :meth:`close` (or
+    leaving a ``with`` block) turns the reuse off again.
+
+    Parameters
+    ----------
+    model : nn.Module
+        DDRNet variant with a ``reuse_context`` attribute, in eval mode.
+    refresh_interval : int
+        Maximum number of frames a cached context is used for; 1 recomputes it
+        on every frame. Larger values are faster and less accurate.
+    scene_threshold : float or None
+        Refresh when the mean absolute difference of the ``thumbnail_size``
+        thumbnails of the frame and the key frame, relative to the key frame's
+        mean absolute value, exceeds this value. None only refreshes on the
+        interval.
+    thumbnail_size : tuple of int
+        Size of the average-pooled thumbnails compared for scene changes.
+    """
+
+    def __init__(self, model, refresh_interval=4, scene_threshold=0.2, thumbnail_size=(16, 32)):
+        self.model = model
+        self.refresh_interval = refresh_interval
+        self.scene_threshold = scene_threshold
+        self.thumbnail_size = tuple(thumbnail_size)
+        self.num_frames = 0
+        self.num_refreshes = 0
+        self.reset()
+
+    def reset(self):
+        """Drops the cached context, e.g. at the start of a new video."""
+        self.model.reuse_context = True
+        self.model.context_cache = None
+        self._key_shape = None
+        self._key_thumbnail = None
+        self._age = 0
+
+    def close(self):
+        """Drops the cached context and restores per-frame inference on the model."""
+        self.model.reuse_context = False
+        self.model.context_cache = None
+        self._key_shape = None
+        self._key_thumbnail = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _needs_refresh(self, shape, thumbnail):
+        # the context is only valid for frames of the key frame's size
+        if self._key_shape != shape:
+            return True
+        if self._age >= self.refresh_interval:
+            return True
+        if self.scene_threshold is None:
+            return False
+        change = (thumbnail - self._key_thumbnail).abs().mean() / \
+            self._key_thumbnail.abs().mean().clamp(min=1e-12)
+        return change.item() > self.scene_threshold
+
+    def __call__(self, image):
+        thumbnail = F.adaptive_avg_pool2d(image, self.thumbnail_size)
+        if self._needs_refresh(image.shape, thumbnail):
+            self.model.context_cache = None
+            self._key_shape = image.shape
+            self._key_thumbnail = thumbnail
+            self._age = 0
+            self.num_refreshes += 1
+        self._age += 1
+        self.num_frames += 1
+        return get_seg_logits(self.model(image))
+
+
+def streaming_cost_report(model, frames, settings, device='cpu'):
+    """Measures latency and accuracy of several streaming settings on a frame sequence.
+
+    Accuracy is the percentage of pixels whose streamed label matches the label
+    of per-frame full inference.
+
+    Parameters
+    ----------
+    frames : sequence of Tensor
+        Consecutive 1 x 3 x H x W frames of a video.
+    settings : sequence of (int, float or None)
+        ``(refresh_interval, scene_threshold)`` pairs.
+
+    Returns the report as a text table with one row per setting.
+    """
+    model.reuse_context = False
+    reference, full_time = [], 0.
+    with torch.no_grad():
+        model(frames[0].to(device))
+        for frame in frames:
+            frame = frame.to(device)
+            start = time.perf_counter()
+            labels = get_seg_logits(model(frame)).argmax(1)
+            if frame.is_cuda:
+                torch.cuda.synchronize(frame.device)
+            full_time += time.perf_counter() - start
+            reference.append(labels)
+    rows = [['full', '', '{:.1f}'.format(1000. * full_time / len(frames)), '100.0', '100.000']]
+    for interval, threshold in settings:
+        elapsed, agree, total = 0., 0, 0
+        with torch.no_grad(), StreamingInference(model, refresh_interval=interval,
+                                                 scene_threshold=threshold) as engine:
+            for frame, labels in zip(frames, reference):
+                frame = frame.to(device)
+                start = time.perf_counter()
+                scores = engine(frame)
+                if frame.is_cuda:
+                    torch.cuda.synchronize(frame.device)
+                elapsed += time.perf_counter() - start
+                agree += (scores.argmax(1) == labels).sum().item()
+                total += labels.numel()
+        rows.append([interval, threshold, '{:.1f}'.format(1000. * elapsed / len(frames)),
+                     '{:.1f}'.format(100. * engine.num_refreshes / engine.num_frames),
+                     '{:.3f}'.format(100. * agree / total)])
+    return format_table(['interval', 'threshold', 'ms/frame', 'refresh %', 'agreement'], rows)
+
+
+class AutocastInference(object):
+    """Runs a segmentation model under bf16/fp16 autocast.
+
+    The BatchNorm layers keep normalizing in fp32 (see
+    ``models.ops.keep_batchnorm_fp32``) and the head logits are cast to fp32
+    before the model upsamples them (see ``models.ops.keep_logits_fp32``), so
+    the full-resolution upsampling, the ``output_labels`` argmax, softmax and the
+    metric accumulation run in full precision. The hooks are no-ops outside
+    autocast, so the model can still be run in fp32 directly; :meth:`close`
+    removes them.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Any registered segmentation model.
+    dtype : torch.dtype
+        ``torch.bfloat16`` (CPU and GPU) or ``torch.float16``.
+    device_type : str
+        'cpu' or 'cuda'.
+    """
+
+    def __init__(self, model, dtype=torch.bfloat16, device_type='cpu'):
+        from models.ops import keep_batchnorm_fp32, keep_logits_fp32
+
+        self.model = model
+        self.dtype = dtype
+        self.device_type = device_type
+        self.handles = keep_batchnorm_fp32(model) + keep_logits_fp32(model)
+
+    def __call__(self, image):
+        with torch.autocast(self.device_type, dtype=self.dtype):
+            outputs = self.model(image)
+        outputs = get_seg_logits(outputs)
+        # output_labels models return int64 labels
+        return outputs.float() if outputs.is_floating_point() else outputs
+
+    def close(self):
+        """Removes the hooks from the model."""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def amp_accuracy_guard(model, amp_model, loader, nclass, max_drop=0.5, max_batches=20, device='cpu'):
+    """Compares autocast inference against fp32 on the first ``max_batches`` batches.
+
+    ``loader`` should hold images that are not part of the evaluation, so the
+    decision is not tuned on the reported result.
+
+    The confusion matrices are summed over all ranks, so every rank takes the
+    same decision.
+
+    Returns
+    -------
+    ok : bool
+        Whether the mIoU drop is at most ``max_drop`` points.
+    report : str
+        Text table of latency, pixAcc and mIoU of both precisions.
+    """
+    results = []
+    amp_name = str(amp_model.dtype).replace('torch.', '')
+    for name, net in (('fp32', model), (amp_name, amp_model)):
+        metric = SegmentationMetric(nclass)
+        elapsed, num_images = 0., 0
+        for i, batch in enumerate(loader):
+            if max_batches is not None and i >= max_batches:
+                break
+            image, target, sizes = batch[0].to(device), batch[1].to(device), batch[3]
+            start = time.perf_counter()
+            with torch.no_grad():
+                scores = get_seg_logits(net(image))
+            if image.is_cuda:
+                torch.cuda.synchronize(image.device)
+            elapsed += time.perf_counter() - start
+            num_images += image.shape[0]
+            metric.update(unpad(scores, sizes), unpad(target, sizes))
+        metric.confusion_matrix = all_reduce_sum(metric.confusion_matrix.to(device))
+        pixAcc, mIoU = metric.get()
+        results.append([name, '{:.1f}'.format(1000. * elapsed / max(num_images, 1)),
+                        '{:.3f}'.format(pixAcc * 100), '{:.3f}'.format(mIoU * 100), mIoU])
+    drop = (results[0][-1] - results[1][-1]) * 100
+    results[1][-1] = '{:+.3f}'.format(-drop)
+    results[0][-1] = ''
+    return drop <= max_drop, format_table(['precision', 'ms/img', 'pixAcc', 'mIoU', 'mIoU delta'], results)
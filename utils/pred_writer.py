@@ -0,0 +1,90 @@
+"""Background writer for colorized prediction masks."""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+from .visualize import get_color_pallete
+
+__all__ = ['PredictionWriter']
+
+logger = logging.getLogger('semantic_segmentation.pred_writer')
+
+
+def _save_prediction(predict, dataset, path):
+    mask = get_color_pallete(predict, dataset)
+    mask.save(path)
+    return path
+
+
+class PredictionWriter(object):
+    """Colorizes and saves label maps on a bounded pool of background workers.
+
+    Parameters
+    ----------
+    dataset : str
+        Dataset name passed to ``get_color_pallete``.
+    num_workers : int
+        Number of writer threads (or processes).
+    max_pending : int
+        Maximum number of queued writes. ``submit`` blocks once it is reached,
+        so a slow disk throttles the model instead of filling up memory.
+    use_processes : bool
+        Use a process pool instead of threads, for when PNG encoding holds the GIL
+        for too long.
+    """
+
+    def __init__(self, dataset, num_workers=2, max_pending=8, use_processes=False):
+        executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.dataset = dataset
+        self._executor = executor_cls(max_workers=num_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._error = None
+
+    def submit(self, predict, path):
+        """Queues a H x W numpy label map to be written to ``path``."""
+        if self._error is not None:
+            raise self._error
+        self._slots.acquire()
+        future = self._executor.submit(_save_prediction, predict, self.dataset, path)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def flush(self):
+        """Waits for the writes queued so far and re-raises the first failure."""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        # waiters wake before the done callbacks run, so _error may not be set yet
+        for future in pending:
+            if future.exception() is not None:
+                raise future.exception()
+        if self._error is not None:
+            raise self._error
+
+    def close(self, raise_error=True):
+        """Waits for all queued writes and re-raises the first failure.
+
+        With ``raise_error=False`` the failure is only logged, e.g. while another
+        exception is already propagating and must not be masked.
+        """
+        self._executor.shutdown(wait=True)
+        if self._error is not None:
+            if raise_error:
+                raise self._error
+            logger.error("Writing predictions failed: {!r}".format(self._error))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_error=exc_type is None)
@@ -1,13 +1,21 @@
 """Evaluation Metrics for Semantic Segmentation"""
+import json
+import os
+import re
+
 import torch
 import numpy as np
 
-__all__ = ['SegmentationMetric', 'batch_pix_accuracy', 'batch_intersection_union',
+__all__ = ['SegmentationMetric', 'ConditionSegmentationMetric', 'condition_tagger', 'batch_confusion_matrix', 'batch_pix_accuracy', 'batch_intersection_union',
            'pixelAccuracy', 'intersectionAndUnion', 'hist_info', 'compute_score']
 
 
 class SegmentationMetric(object):
     """Computes pixAcc and mIoU metric scores
+
+    All scores are derived from one int64 ``nclass x nclass`` confusion matrix
+    (rows: ground truth, columns: prediction). It is accumulated on the device
+    of the predictions and only copied to the host when :meth:`get` is called.
     """
 
     def __init__(self, nclass):
@@ -27,16 +35,10 @@ class SegmentationMetric(object):
         """
 
         def evaluate_worker(self, pred, label):
-            correct, labeled = batch_pix_accuracy(pred, label)
-            inter, union = batch_intersection_union(pred, label, self.nclass)
-
-            self.total_correct += correct
-            self.total_label += labeled
-            if self.total_inter.device != inter.device:
-                self.total_inter = self.total_inter.to(inter.device)
-                self.total_union = self.total_union.to(union.device)
-            self.total_inter += inter
-            self.total_union += union
+            hist = batch_confusion_matrix(pred, label, self.nclass)
+            if self.confusion_matrix.device != hist.device:
+                self.confusion_matrix = self.confusion_matrix.to(hist.device)
+            self.confusion_matrix += hist
 
         if isinstance(preds, torch.Tensor):
             evaluate_worker(self, preds, labels)
@@ -44,25 +46,230 @@ class SegmentationMetric(object):
             for (pred, label) in zip(preds, labels):
                 evaluate_worker(self, pred, label)
 
-    def get(self):
+    def get(self, return_category_iou=False):
         """Gets the current evaluation result.
 
+        Parameters
+        ----------
+        return_category_iou : bool
+            Also return the per-class IoU as a numpy array.
+
         Returns
         -------
         metrics : tuple of float
             pixAcc and mIoU
         """
-        pixAcc = 1.0 * self.total_correct / (2.220446049250313e-16 + self.total_label)  # remove np.spacing(1)
-        IoU = 1.0 * self.total_inter / (2.220446049250313e-16 + self.total_union)
-        mIoU = IoU.mean().item()
-        return pixAcc, mIoU
+        pixAcc, IoU, _ = _confusion_scores(self.confusion_matrix)
+        if return_category_iou:
+            return pixAcc.item(), IoU.mean().item(), IoU.cpu().numpy()
+        return pixAcc.item(), IoU.mean().item()
 
     def reset(self):
         """Resets the internal evaluation result to initial state."""
-        self.total_inter = torch.zeros(self.nclass)
-        self.total_union = torch.zeros(self.nclass)
-        self.total_correct = 0
-        self.total_label = 0
+        self.confusion_matrix = torch.zeros(self.nclass, self.nclass, dtype=torch.int64)
+
+    def state_dict(self):
+        """Accumulated state, for resuming an interrupted evaluation."""
+        return {'confusion_matrix': self.confusion_matrix.cpu()}
+
+    def load_state_dict(self, state_dict):
+        confusion_matrix = state_dict['confusion_matrix']
+        if confusion_matrix.shape != (self.nclass, self.nclass):
+            raise ValueError("confusion matrix of shape {} does not fit {} classes".format(
+                tuple(confusion_matrix.shape), self.nclass))
+        self.confusion_matrix = confusion_matrix.to(self.confusion_matrix.device, torch.int64)
+
+
+class ConditionSegmentationMetric(object):
+    """pixAcc and mIoU sliced by a per-image condition, e.g. the rendered time of day.
+
+    Holds one int64 ``ncondition x nclass x nclass`` confusion matrix. Every
+    :meth:`update` adds all samples of a batch, whatever their conditions, with a
+    single ``bincount``; a condition gets its slice the first time it is seen.
+    Summed over the conditions, the slices equal the ``SegmentationMetric``
+    confusion matrix of the same samples.
+    """
+
+    def __init__(self, nclass, conditions=()):
+        super(ConditionSegmentationMetric, self).__init__()
+        self.nclass = nclass
+        self.conditions = []
+        self.confusion_matrix = torch.zeros(0, nclass, nclass, dtype=torch.int64)
+        for condition in conditions:
+            self.add_condition(condition)
+
+    def add_condition(self, condition):
+        """Returns the slice index of ``condition``, adding an empty slice if it is new."""
+        if condition not in self.conditions:
+            self.conditions.append(condition)
+            self.confusion_matrix = torch.cat(
+                [self.confusion_matrix, self.confusion_matrix.new_zeros(1, self.nclass, self.nclass)])
+        return self.conditions.index(condition)
+
+    def set_conditions(self, conditions):
+        """Reorders the slices to ``conditions``, adding empty slices for unseen ones.
+
+        Distributed ranks see the conditions in different orders; aligning them
+        to a common list first makes the confusion matrices summable.
+        """
+        missing = [c for c in self.conditions if c not in conditions]
+        if missing:
+            raise ValueError("conditions {} would be dropped".format(missing))
+        for condition in conditions:
+            self.add_condition(condition)
+        order = torch.tensor([self.conditions.index(c) for c in conditions],
+                             device=self.confusion_matrix.device)
+        self.confusion_matrix = self.confusion_matrix[order]
+        self.conditions = list(conditions)
+
+    def update(self, preds, labels, conditions):
+        """Updates the slices of ``conditions``.
+
+        Parameters
+        ----------
+        preds, labels
+            As for :meth:`SegmentationMetric.update`: a batched tensor or a list
+            of per-sample tensors.
+        conditions : list
+            The condition tag of every sample.
+        """
+        nclass = self.nclass
+        offsets = [self.add_condition(c) * nclass * nclass for c in conditions]
+        ignore_bin = len(self.conditions) * nclass * nclass
+        if isinstance(preds, torch.Tensor):
+            offset = torch.tensor(offsets, device=labels.device).view(-1, *[1] * (labels.dim() - 1))
+            index = _confusion_index(preds, labels, nclass, offset, ignore_bin).flatten()
+        else:
+            index = torch.cat([_confusion_index(pred, label, nclass, offset, ignore_bin).flatten()
+                               for pred, label, offset in zip(preds, labels, offsets)])
+        hist = torch.bincount(index, minlength=ignore_bin + 1)[:ignore_bin]
+        if self.confusion_matrix.device != hist.device:
+            self.confusion_matrix = self.confusion_matrix.to(hist.device)
+        self.confusion_matrix += hist.reshape(-1, nclass, nclass)
+
+    def get(self, return_category_iou=False):
+        """Gets the current evaluation result of every condition.
+
+        Returns
+        -------
+        metrics : dict
+            Condition -> (pixAcc, mIoU), with the per-class IoU as a third
+            element if ``return_category_iou`` is set.
+        """
+        pixAcc, IoU, _ = _confusion_scores(self.confusion_matrix)
+        mIoU = IoU.mean(-1)
+        results = {}
+        for i, condition in enumerate(self.conditions):
+            results[condition] = (pixAcc[i].item(), mIoU[i].item())
+            if return_category_iou:
+                results[condition] += (IoU[i].cpu().numpy(),)
+        return results
+
+    def table(self, class_names=None):
+        """Per-class IoU of every condition as a text table, one column per condition.
+
+        Classes that appear neither in the labels nor in the predictions of a
+        condition are shown as '-'; like :meth:`SegmentationMetric.get`, mIoU
+        still averages over all classes.
+        """
+        from .benchmark import format_table
+
+        pixAcc, IoU, union = _confusion_scores(self.confusion_matrix)
+        mIoU = IoU.mean(-1)
+        IoU, union = IoU.t().tolist(), union.t().tolist()
+        if class_names is None:
+            class_names = [str(c) for c in range(self.nclass)]
+        rows = []
+        for c, name in enumerate(class_names):
+            rows.append([name] + ['{:.2f}'.format(iou * 100) if u > 0 else '-'
+                                  for iou, u in zip(IoU[c], union[c])])
+        rows.append(['mIoU'] + ['{:.2f}'.format(v * 100) for v in mIoU.tolist()])
+        rows.append(['pixAcc'] + ['{:.2f}'.format(v * 100) for v in pixAcc.tolist()])
+        rows.append(['pixels'] + [str(v) for v in self.confusion_matrix.sum((-2, -1)).tolist()])
+        return format_table(['class'] + [str(c) for c in self.conditions], rows)
+
+    def reset(self):
+        """Empties all slices but keeps the known conditions."""
+        self.confusion_matrix = torch.zeros(len(self.conditions), self.nclass, self.nclass,
+                                            dtype=torch.int64)
+
+    def state_dict(self):
+        """Accumulated state, for resuming an interrupted evaluation."""
+        return {'conditions': list(self.conditions), 'confusion_matrix': self.confusion_matrix.cpu()}
+
+    def load_state_dict(self, state_dict):
+        confusion_matrix = state_dict['confusion_matrix']
+        if confusion_matrix.shape[1:] != (self.nclass, self.nclass):
+            raise ValueError("confusion matrix of shape {} does not fit {} classes".format(
+                tuple(confusion_matrix.shape), self.nclass))
+        self.conditions = list(state_dict['conditions'])
+        self.confusion_matrix = confusion_matrix.to(self.confusion_matrix.device, torch.int64)
+
+
+def condition_tagger(pattern=None, index_file=None, default='other'):
+    """Returns a function mapping an image filename to its condition tag.
+
+    Parameters
+    ----------
+    pattern : str, optional
+        Regular expression searched in the file name; the tag is its first
+        group, or the whole match if it has no groups.
+    index_file : str, optional
+        Sidecar JSON file mapping file names (with or without extension) to
+        tags. It takes precedence over ``pattern``.
+    default : str
+        Tag of the files neither source knows.
+    """
+    index = {}
+    if index_file is not None:
+        with open(index_file) as f:
+            index = json.load(f)
+    regex = re.compile(pattern) if pattern is not None else None
+
+    def tag(filename):
+        name = os.path.basename(filename)
+        for key in (name, os.path.splitext(name)[0]):
+            if key in index:
+                return index[key]
+        match = regex.search(name) if regex is not None else None
+        if match is None:
+            return default
+        return match.group(1) if match.groups() else match.group(0)
+    return tag
+
+
+def _confusion_index(output, target, nclass, offset, ignore_bin):
+    # flat confusion matrix bin of every pixel; ignored pixels go to one extra
+    # bin that is dropped afterwards, which avoids a device sync for boolean indexing
+    if output.dim() == target.dim():
+        predict = output.long()
+    else:
+        predict = torch.argmax(output, 1)
+    target = target.long()
+    keep = (target >= 0) & (target < nclass)
+    return torch.where(keep, offset + target * nclass + predict, ignore_bin)
+
+
+def _confusion_scores(confusion_matrix):
+    # pixAcc, per-class IoU and union of one or a stack of confusion matrices
+    hist = confusion_matrix.double()
+    inter = torch.diagonal(hist, dim1=-2, dim2=-1)
+    union = hist.sum(-2) + hist.sum(-1) - inter
+    pixAcc = inter.sum(-1) / (2.220446049250313e-16 + hist.sum((-2, -1)))  # remove np.spacing(1)
+    IoU = inter / (2.220446049250313e-16 + union)
+    return pixAcc, IoU, union
+
+
+def batch_confusion_matrix(output, target, nclass):
+    """Confusion matrix of one batch with a single ``bincount``.
+
+    ``output`` holds N x C x H x W scores or N x H x W predicted labels, ``target``
+    N x H x W labels; pixels whose label is outside ``[0, nclass)`` are ignored.
+    The result is an int64 ``nclass x nclass`` tensor on the device of ``output``.
+    """
+    index = _confusion_index(output, target, nclass, 0, nclass * nclass)
+    hist = torch.bincount(index.flatten(), minlength=nclass * nclass + 1)
+    return hist[:nclass * nclass].reshape(nclass, nclass)
 
 
 # pytorch version